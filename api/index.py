@@ -1,34 +1,46 @@
 import os
 from io import StringIO
 import csv
-import pandas as pd
+import zlib
+import gzip
+import json
+import base64
+import zipfile
+import tempfile
 import time
-import psycopg2
-from datetime import datetime, timedelta
+import threading
+import atexit
+import queue
+import heapq
+import itertools
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from array import array
 from sqlalchemy import create_engine
-from sqlalchemy import text
-from flask import Flask, jsonify
+from sqlalchemy import text, bindparam, event
+from sqlalchemy.pool import QueuePool, NullPool
+from flask import Flask, jsonify, g, has_request_context, stream_with_context, copy_current_request_context
 from flask_cors import CORS
 from flask import send_file, Response
 from flask import request
-import smtplib
 import random
+import re
 import hashlib
 import binascii
 from dotenv import load_dotenv
 
 load_dotenv()
 
-smtp_config = {
-    'host': os.getenv('SMTP_HOST'),
-    'port': int(os.getenv('SMTP_PORT')), 
-    'user': os.getenv('SMTP_USER'),
-    'password': os.getenv('SMTP_PASSWORD')
-}
-engine = create_engine(os.getenv('POSTGRES_URL'))
+engine = None
+engineLock = threading.Lock()
+serverless = os.getenv('VERCEL') == '1' or os.getenv('SERVERLESS', '').lower() in ('1', 'true', 'yes')
+
+patientDataColumns = ['ptid', 'ptname', 'timestamp', 'devid', 'accx', 'accy', 'accz', 'gyrox', 'gyroy', 'gyroz', 'hr', 'presence', 'battery']
+sessionHeaderBytes = len(','.join(patientDataColumns)) + 2
+sampleFields = ['timestamp', 'devID', 'accX', 'accY', 'accZ', 'gyroX', 'gyroY', 'gyroZ', 'hr', 'presence', 'battery']
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Next-Cursor'])
 
 @app.route('/')
 def main_page():
@@ -36,88 +48,118 @@ def main_page():
     
 @app.route('/stored-data', methods=['POST'])
 def stored_data():
-    deviceBatteries()
     dataString = request.data.decode()
     dataArray = dataString.split(',')
     
-    fields = ['timestamp', 'devID', 'accX', 'accY', 'accZ', 'gyroX', 'gyroY', 'gyroZ', 'hr', 'presence', 'battery']
-    
-    currentTimestamp = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    receivedAt = datetime.utcnow().replace(microsecond=0)
+    currentTimestamp = receivedAt.strftime('%Y-%m-%d %H:%M:%S')
     
     dataArray.insert(0, currentTimestamp)
-    data = {field: dataArray[index] if index < len(dataArray) else '0' for index, field in enumerate(fields)}
+    data = {field: dataArray[index] if index < len(dataArray) else '0' for index, field in enumerate(sampleFields)}
 
     if 'devID' in data and data['devID'].isdigit():
-        devid = f"ST-{'0' if int(data['devID']) < 10 else ''}{data['devID']}"
-        assignmentQuery = text("SELECT devassigned, devassignedname FROM psyche_registereddevices WHERE devid = :devid")
-        with engine.connect() as connection:
-            assignmentResult = connection.execute(assignmentQuery, {'devid': devid})
-            row = assignmentResult.fetchone()
+        try:
+            sampleNumbers = parseSampleNumbers(data)
+        except (ValueError, OverflowError):
+            return "Invalid sample values", 400
+        devid = formatDeviceID(data['devID'])
+        with getEngine().connect() as connection:
+            row = deviceAssignments.getMany(connection, [devid])[devid]
             if row:
                 ptid, ptname = row
-                if (ptid and ptid != 'None') and (ptname and ptname != 'None') and int(data['presence']) != 0:
-                    dataInsertQuery = text('''
-                        INSERT INTO psyche_patientdata
-                        (ptid, ptname,  timestamp, devid, accx, accy, accz, gyrox, gyroy, gyroz, hr, presence, battery)
-                        VALUES (:ptid, :ptname,  :timestamp, :devid, :accx, :accy, :accz, :gyrox, :gyroy, :gyroz, :hr, :presence, :battery)
-                    ''')
-                    dataInsertValue = {
-                        'ptid': ptid, 
-                        'ptname': ptname, 
-                        'timestamp': currentTimestamp, 
-                        'devid': dataArray[1], 
-                        'accx': dataArray[2],  
-                        'accy': dataArray[3], 
-                        'accz': dataArray[4], 
-                        'gyrox': dataArray[5], 
-                        'gyroy': dataArray[6], 
-                        'gyroz': dataArray[7], 
-                        'hr': dataArray[8], 
-                        'presence': dataArray[9], 
-                        'battery': dataArray[10]
-                    }
-                    connection.execute(dataInsertQuery, dataInsertValue)
+                updateDeviceBatteries(connection, {devid: sampleNumbers['battery']})
+                if isAssigned(ptid, ptname):
+                    sample = {**data, **sampleNumbers, 'timestamp': receivedAt}
+                    if int(data['presence']) != 0 and not queuePatientData(connection, [patientDataRow(ptid, ptname, sample)]):
+                        return jsonify({"message": "Ingest buffer is full. Please retry."}), 429
+                    publishSamples([(devid, ptid, ptname, sample)])
                             
                 return jsonify({"message": data}), 200
             else:
                 return "Invalid devID", 400
     else:
         return f"Invalid devID", 400
+
+@app.route('/stored-data-batch', methods=['POST'])
+def stored_data_batch():
+    samples = []
+    rejected = []
+    if request.mimetype == binaryFrameMimetype:
+        try:
+            samples, rejected = decodeFrames(request.data)
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
+        receivedCount = len(samples) + len(rejected)
+    else:
+        dataLines = [line for line in request.data.decode().splitlines() if line.strip()]
+        receivedCount = len(dataLines)
+        for lineIndex, line in enumerate(dataLines):
+            try:
+                samples.append((lineIndex, parseBatchSample(line.split(','))))
+            except (ValueError, OverflowError, OSError):
+                rejected.append(lineIndex)
+
+    if not receivedCount:
+        return jsonify({"message": "No samples provided."}), 400
+
+    try:
+        devids = {formatDeviceID(data['devID']) for _, data in samples}
+        with getEngine().begin() as connection:
+            assignments = deviceAssignments.getMany(connection, devids)
+
+            patientDataRows = []
+            liveSamples = []
+            latestSamples = {}
+            for lineIndex, data in samples:
+                devid = formatDeviceID(data['devID'])
+                if not assignments[devid]:
+                    rejected.append(lineIndex)
+                    continue
+                if devid not in latestSamples or data['timestamp'] >= latestSamples[devid]['timestamp']:
+                    latestSamples[devid] = data
+
+                ptid, ptname = assignments[devid]
+                if isAssigned(ptid, ptname):
+                    liveSamples.append((devid, ptid, ptname, data))
+                    if int(data['presence']) != 0:
+                        patientDataRows.append(patientDataRow(ptid, ptname, data))
+
+            if not queuePatientData(connection, patientDataRows):
+                return jsonify({"message": "Ingest buffer is full. Please retry."}), 429
+            publishSamples(sorted(liveSamples, key=lambda liveSample: liveSample[3]['timestamp']))
+            updateDeviceBatteries(connection, {devid: data['battery'] for devid, data in latestSamples.items()})
+
+        return jsonify({
+            "received": receivedCount,
+            "stored": len(patientDataRows),
+            "rejected": sorted(rejected)
+        }), 200
+
+    except Exception as e:
+        return jsonify({"message": "Error processing request: " + str(e)}), 500
     
 @app.route('/get-sessions', methods=['GET'])
 def get_sessions():
     
     try:
         session_details = [] 
-        with engine.connect() as connection:
-            selectUniqueIDsQuery = text('''
-                SELECT ptid, MIN(ptname) AS ptname
-                FROM psyche_patientdata
-                GROUP BY ptid;
+        with getEngine().connect() as connection:
+            selectSessionsQuery = text('''
+                SELECT ptid, ptname, rowcount, sizebytes, firsttimestamp, lasttimestamp
+                FROM psyche_sessionsummary
+                WHERE rowcount > 0
+                ORDER BY ptid;
             ''')
-            selecteUniquePatientIDsResult = connection.execute(selectUniqueIDsQuery).fetchall()
-
-            for ptid, ptname in selecteUniquePatientIDsResult:
-                patientDataQuery = text('''
-                    SELECT * FROM psyche_patientdata WHERE ptid = :ptid
-                ''')
-                patientDataResult = connection.execute(patientDataQuery, {'ptid': ptid}).fetchall()
-
-                output = StringIO()
-                writer = csv.writer(output)
-                writer.writerow([column for column in patientDataResult[0].keys()]) 
-                for row in patientDataResult:
-                    writer.writerow([value for value in row])
-
-                csv_content = output.getvalue()
-                size_bytes = int(len(csv_content.encode('utf-8'))) 
+            selectSessionsResult = connection.execute(selectSessionsQuery).fetchall()
 
+            for ptid, ptname, rowCount, sizeBytes, firstTimestamp, lastTimestamp in selectSessionsResult:
                 session_details.append({
                     "name": f'{ptname}-{ptid}_RTData',
-                    "sizeBytes": size_bytes,
+                    "sizeBytes": int(sessionHeaderBytes + sizeBytes),
+                    "rowCount": int(rowCount),
+                    "firstTimestamp": formatTimestamp(firstTimestamp),
+                    "lastTimestamp": formatTimestamp(lastTimestamp),
                 })
-                
-                output.close()
 
         return jsonify({"sessions": session_details}), 200
 
@@ -129,32 +171,236 @@ def export_sessions():
     data = request.json
     fileName = data.get('fileName', '')
     ptID = fileName.split('-')[1].split('_')[0]
+    exportFormat = data.get('format', 'csv')
+    useGzip = bool(data.get('gzip', False)) and exportFormat == 'csv'
+
+    if exportFormat not in ('csv', 'npz'):
+        return jsonify({"message": "Unsupported export format."}), 400
 
     try:
-        with engine.connect() as connection:
-            patientDataQuery = text('SELECT * FROM psyche_patientdata WHERE ptid = :ptid')
-            patientDataResult = connection.execute(patientDataQuery, {'ptid': ptID})
-            rows = patientDataResult.fetchall()
-            if not rows:
-                return jsonify({"message": "No data found."}), 404
+        export = PatientExport(ptID)
+        if not export.firstRows:
+            export.close()
+            return jsonify({"message": "No data found."}), 404
+
+        if exportFormat == 'npz':
+            encodedChunks = npzChunks(export.columns, export.chunks())
+            mimetype = 'application/octet-stream'
+        else:
+            encodedChunks = csvChunks(export.columns, export.chunks())
+            mimetype = 'text/csv'
+        if useGzip:
+            encodedChunks = gzipChunks(encodedChunks)
 
-            output = StringIO()
-            writer = csv.writer(output)
-            writer.writerow(rows[0].keys()) 
-            for row in rows:
-                writer.writerow(row)
-                
-            output.seek(0)
+        response = Response(stream_with_context(streamPatientExport(export, encodedChunks)), mimetype=mimetype)
+        response.headers['Content-Disposition'] = f'attachment; filename={fileName}.{exportFormat}'
+        if useGzip:
+            response.headers['Content-Encoding'] = 'gzip'
+        return response
 
-            patientDeleteQuery = text('DELETE FROM psyche_patientdata WHERE ptid = :ptid')
-            connection.execute(patientDeleteQuery, {'ptid': ptID})
+    except Exception as e:
+        return jsonify({"message": f"Error processing request: {str(e)}"}), 500
 
-            response = Response(output.getvalue(), mimetype='text/csv')
-            response.headers['Content-Disposition'] = f'attachment; filename={fileName}.csv'
-            return response
+@app.route('/export-bundle', methods=['POST'])
+def export_bundle():
+    data = request.json
+    ptIDs = data.get('ptIDs') or []
+    ptUnit = data.get('unit')
+    exportFormat = data.get('format', 'csv')
+
+    if exportFormat not in ('csv', 'npz'):
+        return jsonify({"message": "Unsupported export format."}), 400
+    if not isinstance(ptIDs, list) or not all(isinstance(ptID, str) for ptID in ptIDs):
+        return jsonify({"message": "ptIDs must be a list of patient IDs."}), 400
+    if not ptIDs and not ptUnit:
+        return jsonify({"message": "No patients selected."}), 400
+
+    try:
+        if ptUnit:
+            with getEngine().connect() as connection:
+                unitPatientsQuery = text('SELECT ptid FROM psychepatientinfo WHERE pttag = :pttag ORDER BY ptid')
+                ptIDs = [row[0] for row in connection.execute(unitPatientsQuery, {'pttag': ptUnit})]
+        ptIDs = list(dict.fromkeys(ptIDs))
+        if not ptIDs:
+            return jsonify({"message": "No patients found."}), 404
+
+        response = Response(stream_with_context(exportBundle(ptIDs, exportFormat)), mimetype='application/zip')
+        response.headers['Content-Disposition'] = f"attachment; filename=PSYCHE-{ptUnit or 'bundle'}_RTData.zip"
+        return response
 
     except Exception as e:
-        return jsonify({"message": f"Error processing request: {str(e)}"}), 500
+        return jsonify({"message": "Error processing request: " + str(e)}), 500
+
+@app.route('/patient-data', methods=['POST'])
+def get_patient_data():
+    data = request.json
+    ptID = data.get('ptID')
+
+    try:
+        resolution = float(data.get('resolution', 0))
+        limit = min(int(data.get('limit', 1000)), maxRawPoints)
+        if data.get('cursor'):
+            decodePageCursor(data['cursor'])
+    except (ValueError, TypeError, OverflowError, OSError):
+        return jsonify({"message": "Invalid resolution, limit or cursor."}), 400
+
+    try:
+        endTimestamp = parseDeviceTimestamp(str(data['end'])) if data.get('end') else datetime.utcnow()
+        startTimestamp = parseDeviceTimestamp(str(data['start'])) if data.get('start') else endTimestamp - timedelta(hours=24)
+    except (ValueError, OverflowError, OSError):
+        return jsonify({"message": "Invalid start or end timestamp."}), 400
+
+    if not ptID or not 0 <= resolution < float('inf') or limit <= 0 or endTimestamp <= startTimestamp:
+        return jsonify({"message": "Invalid patient data query."}), 400
+    if resolution and (endTimestamp - startTimestamp).total_seconds() / resolution > maxBucketPoints:
+        return jsonify({"message": f"Requested resolution would return more than {maxBucketPoints} points."}), 400
+
+    try:
+        with getEngine().connect() as connection:
+            if resolution:
+                return jsonify({
+                    "points": patientDataBuckets(connection, ptID, startTimestamp, endTimestamp, resolution)
+                }), 200
+
+            points, nextCursor = patientDataPage(connection, ptID, startTimestamp, endTimestamp, limit, data.get('cursor'))
+            return jsonify({"points": points, "nextCursor": nextCursor}), 200
+
+    except Exception as e:
+        return jsonify({"message": "Error processing request: " + str(e)}), 500
+
+@app.route('/live-vitals', methods=['POST'])
+def get_live_vitals():
+    data = request.get_json(silent=True) or {}
+    ptID = data.get('ptID')
+
+    try:
+        window = max(int(data.get('window', 60)), 0)
+    except (ValueError, TypeError, OverflowError):
+        return jsonify({"message": "Invalid window."}), 400
+
+    return jsonify({"devices": liveVitals.snapshot(ptID, window)}), 200
+
+@app.route('/live-stream', methods=['GET'])
+def live_stream():
+    subscriber = liveBroker.subscribe(request.args.get('ptID'), request.args.get('devID'))
+    if subscriber is None:
+        return jsonify({"message": "Too many live stream subscribers. Please retry later."}), 503
+
+    response = Response(stream_with_context(liveBroker.stream(subscriber)), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/patient-rollups', methods=['POST'])
+def get_patient_rollups():
+    data = request.json
+    ptID = data.get('ptID')
+
+    try:
+        resolution = int(data.get('resolution', 60))
+    except (ValueError, TypeError):
+        return jsonify({"message": "Invalid resolution."}), 400
+
+    try:
+        endTimestamp = parseDeviceTimestamp(str(data['end'])) if data.get('end') else datetime.utcnow()
+        startTimestamp = parseDeviceTimestamp(str(data['start'])) if data.get('start') else endTimestamp - timedelta(days=7)
+    except (ValueError, OverflowError, OSError):
+        return jsonify({"message": "Invalid start or end timestamp."}), 400
+
+    if not ptID or resolution < 60 or resolution % 60 or endTimestamp <= startTimestamp:
+        return jsonify({"message": "Invalid rollup query."}), 400
+
+    try:
+        with getEngine().connect() as connection:
+            rollupQuery = text('''
+                SELECT to_timestamp(floor(extract(epoch FROM bucket) / :resolution) * :resolution) AT TIME ZONE 'UTC' AS period,
+                       SUM(samples) AS samples,
+                       SUM(presentsamples) AS presentsamples,
+                       SUM(hrsum) AS hrsum,
+                       SUM(hrcount) AS hrcount,
+                       MAX(hrmax) AS hrmax,
+                       SUM(activitysum) AS activitysum,
+                       SUM(gyroenergysum) AS gyroenergysum
+                FROM psyche_patientrollup
+                WHERE ptid = :ptid AND bucket >= :start AND bucket < :end
+                GROUP BY period
+                ORDER BY period
+            ''')
+            rollupResult = connection.execute(rollupQuery, {'ptid': ptID, 'start': startTimestamp, 'end': endTimestamp, 'resolution': resolution})
+
+            rollups = [
+                {
+                    "timestamp": formatTimestamp(row['period']),
+                    "samples": int(row['samples']),
+                    "presenceFraction": float(row['presentsamples']) / float(row['samples']) if row['samples'] else None,
+                    "hrMean": float(row['hrsum']) / float(row['hrcount']) if row['hrcount'] else None,
+                    "hrMax": toFloat(row['hrmax']),
+                    "activityMean": float(row['activitysum']) / float(row['presentsamples']) if row['presentsamples'] else None,
+                    "gyroEnergyMean": float(row['gyroenergysum']) / float(row['presentsamples']) if row['presentsamples'] else None
+                } for row in rollupResult
+            ]
+
+            return jsonify({"rollups": rollups}), 200
+
+    except Exception as e:
+        return jsonify({"message": "Error processing request: " + str(e)}), 500
+
+@app.route('/patient-features', methods=['POST'])
+def get_patient_features():
+    data = request.json
+    ptIDs = data.get('ptIDs') or ([data['ptID']] if data.get('ptID') else [])
+
+    try:
+        epochSeconds = float(data.get('epoch', featureEpochSeconds))
+    except (ValueError, TypeError):
+        return jsonify({"message": "Invalid epoch."}), 400
+    if not isinstance(ptIDs, list) or not all(isinstance(ptID, str) for ptID in ptIDs):
+        return jsonify({"message": "ptIDs must be a list of patient IDs."}), 400
+
+    try:
+        endTimestamp = parseDeviceTimestamp(str(data['end'])) if data.get('end') else datetime.utcnow()
+        startTimestamp = parseDeviceTimestamp(str(data['start'])) if data.get('start') else endTimestamp - timedelta(hours=24)
+    except (ValueError, OverflowError, OSError):
+        return jsonify({"message": "Invalid start or end timestamp."}), 400
+
+    if not ptIDs or len(ptIDs) > maxFeaturePatients or not 0 < epochSeconds < float('inf') or endTimestamp <= startTimestamp:
+        return jsonify({"message": "Invalid feature query."}), 400
+
+    try:
+        return jsonify({
+            "features": computePatientFeatures(ptIDs, startTimestamp, endTimestamp, epochSeconds, featureWorkers)
+        }), 200
+
+    except Exception as e:
+        return jsonify({"message": "Error processing request: " + str(e)}), 500
+
+@app.before_request
+def start_request_metrics():
+    g.metricsStart = time.perf_counter()
+    g.queryCount = 0
+    g.querySeconds = 0.0
+
+@app.after_request
+def record_request_metrics(response):
+    if 'metricsStart' in g:
+        requestMetrics = (request.method, metrics.routeLabel(), request.content_length or 0, g._get_current_object())
+        response.call_on_close(lambda: metrics.recordRequest(*requestMetrics, response))
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify({
+        "deviceAssignments": deviceAssignments.stats(),
+        "ingestBuffer": ingestBuffer.stats() if ingestBuffer else None,
+        "emailOutbox": emailOutbox.stats(),
+        "responseCache": responseCache.stats(),
+        "liveStream": liveBroker.stats(),
+        "patientRollups": patientRollups.stats()
+    }), 200
 
 @app.route('/login', methods=['POST'])
 def login():
@@ -163,7 +409,7 @@ def login():
     password = data['password']
     
     try:
-        with engine.connect() as connection:
+        with getEngine().connect() as connection:
             loginQuery = text('SELECT salt, hashedpassword FROM psycheusers WHERE username = :username OR email = :username;')
             loginResult = connection.execute(loginQuery, {'username': username}).fetchone()
 
@@ -194,7 +440,7 @@ def register_user():
         return jsonify({"message": "Missing required registration info."}), 400
 
     try:
-        with engine.connect() as connection:
+        with getEngine().connect() as connection:
             userCheckQuery = text('SELECT email, username FROM psycheusers WHERE email = :email OR username = :username;')
             userCheckResult = connection.execute(userCheckQuery, {'email': email, 'username': username}).fetchall()
 
@@ -208,18 +454,21 @@ def register_user():
 
             salt, hashedPassword = generateSaltedPassword(password)
 
+            userCreationQuery = text('''
+                INSERT INTO psycheusers (firstname, lastname, username, email, password, hashedpassword, salt, image)
+                VALUES (:firstname, :lastname, :username, :email, :password, :hashedpassword, :salt, :image)
+            ''')
             userCreationValues = {
-                'firstname': [firstName],
-                'lastname': [lastName],
-                'username': [username],
-                'email': [email],
-                'password': [password],
-                'hashedpassword': [hashedPassword],
-                'salt': [salt],
-                'image': [str(image)]
+                'firstname': firstName,
+                'lastname': lastName,
+                'username': username,
+                'email': email,
+                'password': password,
+                'hashedpassword': hashedPassword,
+                'salt': salt,
+                'image': str(image)
             }
-            userCreationResult = pd.DataFrame(userCreationValues)
-            userCreationResult.to_sql('psycheusers', engine, if_exists='append', index=False)
+            connection.execute(userCreationQuery, userCreationValues)
             
         return jsonify({}), 200
 
@@ -231,7 +480,7 @@ def reset_password():
     email = request.json['email']
     
     try:
-        with engine.connect() as connection:
+        with getEngine().connect() as connection:
             resetVerificationQuery = text('SELECT email, password, username FROM psycheusers WHERE email = :email;')
             resetVerificationResult = connection.execute(resetVerificationQuery, {'email': email}).fetchone()
 
@@ -249,18 +498,9 @@ def reset_password():
             )
             connection.execute(insertResetToken, {'username': username, 'resettoken': resetCode, 'expirationtimestamp': expiration_timestamp})
             
-        try:
-            server = smtplib.SMTP(smtp_config['host'], smtp_config['port'])
-            server.starttls()
-            server.login(smtp_config['user'], smtp_config['password'])
-
-            subject = 'Password Reset Code'
-            message = f'Your password reset code is: {resetCode}'
-            msg = f'Subject: {subject}\n\n{message}'
-
-            server.sendmail(smtp_config['user'], email, msg)
-            server.quit()
-        except Exception as e:
+        subject = 'Password Reset Code'
+        message = f'Your password reset code is: {resetCode}'
+        if not emailOutbox.send(email, f'Subject: {subject}\n\n{message}'):
             return jsonify({'message': 'Unable to send verification email.'}), 501
 
         return jsonify({
@@ -281,7 +521,7 @@ def change_password():
     try:
         salt, hashedPassword = generateSaltedPassword(newPassword)
 
-        with engine.connect() as connection: 
+        with getEngine().connect() as connection: 
             updatePasswordQuery = text('''
                 UPDATE psycheusers 
                 SET password = :password, hashedpassword = :hashedpassword, salt = :salt 
@@ -300,30 +540,42 @@ def change_password():
     except Exception as e:
         return jsonify({"message": "Error processing request: " + str(e)}), 500
     
+patientFields = ['ptid', 'ptname', 'ptsex', 'ptage', 'pttag']
+
 @app.route('/get-patients', methods=['POST'])
 def get_patients_current():
     data = request.json
     patientSet = data.get('patientTable')
+    patientTable = 'psychepatientinfo_archive' if patientSet == 'archive' else 'psychepatientinfo'
+    ptUnit = data.get('unit')
+    cursor = data.get('cursor')
+    fields = [field for field in patientFields if field in (data.get('fields') or patientFields)]
+    if 'ptid' not in fields:
+        fields.insert(0, 'ptid')
+
+    try:
+        limit = min(int(data['limit']), maxListPageSize) if data.get('limit') else None
+        if cursor:
+            decodeListCursor(cursor)
+    except (ValueError, TypeError):
+        return jsonify({"message": "Invalid limit or cursor."}), 400
+    if limit is not None and limit <= 0:
+        return jsonify({"message": "Invalid limit or cursor."}), 400
+
+    variant = (ptUnit, limit, cursor, tuple(fields))
+    cachedResponse = responseCache.get(patientTable, variant)
+    if cachedResponse:
+        return conditionalResponse(cachedResponse)
+    tableVersion = responseCache.version(patientTable)
     
     try:
-        with engine.connect() as connection:
-            if patientSet == 'archive':
-                selectPatientsQuery = text('SELECT ptid, ptname, ptsex, ptage, pttag FROM psychepatientinfo_archive')
-            else: 
-                selectPatientsQuery = text('SELECT ptid, ptname, ptsex, ptage, pttag FROM psychepatientinfo')
-            result = connection.execute(selectPatientsQuery).fetchall()
+        with getEngine().connect() as connection:
+            filters = ['pttag = :pttag'] if ptUnit else []
+            rows, headers = listPage(connection, patientTable, 'ptid', fields, filters, {'pttag': ptUnit}, limit, cursor)
 
-            patientInfoList = [
-                {
-                    'ptid': row[0],
-                    'ptname': row[1],
-                    'ptsex': row[2],
-                    'ptage': row[3],
-                    'pttag': row[4]
-                } for row in result
-            ]
+            patientInfoList = [{field: row[field] for field in fields} for row in rows]
 
-            return jsonify(patientInfoList), 200
+            return conditionalResponse(responseCache.put(patientTable, tableVersion, patientInfoList, variant, headers))
 
     except Exception as e:
         return jsonify({"message": "Error processing request: " + str(e)}), 500
@@ -338,7 +590,7 @@ def enroll_patient():
     ptID = data.get('patientID')
 
     try:
-        with engine.connect() as connection:
+        with getEngine().connect() as connection:
             checkIDQuery = text("""
                 SELECT ptid 
                 FROM psychepatientinfo 
@@ -366,12 +618,78 @@ def enroll_patient():
             }
             
             connection.execute(enrollPatientQuery, enrollPatientValues)
+            responseCache.invalidate('psychepatientinfo')
             
             return jsonify({}), 200
 
     except Exception as e:
         return jsonify({"message": "Error processing request: " + str(e)}), 500
 
+@app.route('/enroll-patients', methods=['POST'])
+def enroll_patients():
+    data = request.json
+    patients = data.get('patients') or []
+    if not isinstance(patients, list) or not all(isinstance(patient, dict) for patient in patients):
+        return jsonify({"message": "patients must be a list of objects."}), 400
+
+    results = []
+    enrollPatientValues = []
+    for patient in patients:
+        ptID = patient.get('patientID')
+        result = {"patientID": ptID, "status": "enrolled"}
+        results.append(result)
+        try:
+            ptAge = int(patient.get('patientAge'))
+        except (TypeError, ValueError):
+            result.update(status="rejected", message="Invalid patient age")
+            continue
+        if not ptID:
+            result.update(status="rejected", message="Missing patient ID")
+            continue
+        enrollPatientValues.append((result, {
+            'ptid': ptID,
+            'ptname': patient.get('patientName'),
+            'ptsex': patient.get('patientSex'),
+            'ptage': ptAge,
+            'pttag': patient.get('patientUnit')
+        }))
+
+    try:
+        with getEngine().begin() as connection:
+            usedIDs = set()
+            if enrollPatientValues:
+                checkIDQuery = text("""
+                    SELECT ptid
+                    FROM psychepatientinfo
+                    WHERE ptid IN :ptids
+                    UNION
+                    SELECT ptid
+                    FROM psychepatientinfo_archive
+                    WHERE ptid IN :ptids
+                """).bindparams(bindparam('ptids', expanding=True))
+                usedIDs = {row[0] for row in connection.execute(checkIDQuery, {'ptids': [values['ptid'] for _, values in enrollPatientValues]})}
+
+            acceptedValues = []
+            for result, values in enrollPatientValues:
+                if values['ptid'] in usedIDs:
+                    result.update(status="rejected", message="Patient ID already in use")
+                    continue
+                usedIDs.add(values['ptid'])
+                acceptedValues.append(values)
+
+            if acceptedValues:
+                enrollPatientQuery = text("""
+                    INSERT INTO psychepatientinfo (ptid, ptname, ptsex, ptage, pttag)
+                    VALUES (:ptid, :ptname, :ptsex, :ptage, :pttag)
+                """)
+                connection.execute(enrollPatientQuery, acceptedValues)
+                responseCache.invalidate('psychepatientinfo')
+
+            return jsonify({"results": results}), 200
+
+    except Exception as e:
+        return jsonify({"message": "Error processing request: " + str(e)}), 500
+
 @app.route('/edit-patient', methods=['POST'])
 def edit_patient():
     data = request.json
@@ -382,7 +700,7 @@ def edit_patient():
     ptID = data.get('patientID')
 
     try:
-        with engine.connect() as connection:
+        with getEngine().connect() as connection:
             
             editPatientQuery = text("""
                 UPDATE psychepatientinfo SET ptname = :ptname, ptsex = :ptsex, ptage = :ptage, pttag = :pttag  
@@ -397,6 +715,7 @@ def edit_patient():
             }
             
             connection.execute(editPatientQuery, editPatientValues)
+            responseCache.invalidate('psychepatientinfo')
             
             return jsonify({}), 200
 
@@ -409,7 +728,9 @@ def archive_patient():
     ptID = data.get('patientID')
 
     try:
-        with engine.connect() as connection:
+        manifest = archivePatientData(ptID) if archiveDirectory else None
+
+        with getEngine().connect() as connection:
             copyUserQuery = text("""
                 INSERT INTO psychepatientinfo_archive
                 SELECT * FROM psychepatientinfo
@@ -422,19 +743,52 @@ def archive_patient():
                 WHERE ptid = :ptid
             """)
             connection.execute(deleteUserQuery, {'ptid': ptID})
+            responseCache.invalidate('psychepatientinfo', 'psychepatientinfo_archive')
 
-            return jsonify({}), 200
+            return jsonify({"archivedRows": manifest['rows'] if manifest else 0}), 200
 
     except Exception as e:
         return jsonify({"message": "Error processing request: " + str(e)}), 500
 
+@app.route('/archived-data', methods=['POST'])
+def get_archived_data():
+    data = request.json
+    ptID = data.get('ptID')
+
+    try:
+        limit = min(int(data.get('limit', 1000)), maxRawPoints)
+        if data.get('cursor'):
+            decodeArchiveCursor(data['cursor'])
+    except (ValueError, TypeError, OverflowError):
+        return jsonify({"message": "Invalid limit or cursor."}), 400
+
+    try:
+        endTimestamp = parseDeviceTimestamp(str(data['end'])) if data.get('end') else datetime.utcnow()
+        startTimestamp = parseDeviceTimestamp(str(data['start'])) if data.get('start') else datetime(1970, 1, 1)
+    except (ValueError, OverflowError, OSError):
+        return jsonify({"message": "Invalid start or end timestamp."}), 400
+
+    if not archiveDirectory:
+        return jsonify({"message": "Patient data archival is not configured."}), 404
+    if not ptID or limit <= 0 or endTimestamp <= startTimestamp:
+        return jsonify({"message": "Invalid archived data query."}), 400
+
+    try:
+        points, nextCursor = archivedPatientData(ptID, startTimestamp, endTimestamp, limit, data.get('cursor'))
+        return jsonify({"points": points, "nextCursor": nextCursor}), 200
+
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    except Exception as e:
+        return jsonify({"message": "Error processing request: " + str(e)}), 500
+
 @app.route('/selected-patient-placeholders', methods=['POST'])
 def edit_patient_placeholders():
     data = request.json
     ptID = str(data.get('patientID'))
     
     try: 
-        with engine.connect() as connection:
+        with getEngine().connect() as connection:
             patientPlaceholderQuery = text('SELECT * FROM psychepatientinfo WHERE ptid = :ptid')
             patientPlaceholderResult = connection.execute(patientPlaceholderQuery, {'ptid': ptID}).fetchall()
 
@@ -460,24 +814,50 @@ def edit_patient_placeholders():
     except Exception as e:
         return jsonify({"message": "Error processing request: " + str(e)}), 500
     
+deviceFields = {
+    'devType': 'devtype',
+    'devID': 'devid',
+    'assignedTo': 'devassignedname',
+    'lastAssigned': 'lastassignment',
+    'battery': 'devbattery'
+}
+
 @app.route('/get-devices', methods=['GET'])
 def get_device_info(): 
+    assigned = request.args.get('assigned')
+    cursor = request.args.get('cursor')
+    requestedFields = request.args.get('fields', '').split(',') if request.args.get('fields') else list(deviceFields)
+    fields = [field for field in deviceFields if field in requestedFields or field == 'devID']
+
+    try:
+        limit = min(int(request.args['limit']), maxListPageSize) if request.args.get('limit') else None
+        if cursor:
+            decodeListCursor(cursor)
+    except (ValueError, TypeError):
+        return jsonify({"message": "Invalid limit or cursor."}), 400
+    if (limit is not None and limit <= 0) or assigned not in (None, 'true', 'false'):
+        return jsonify({"message": "Invalid device list query."}), 400
+
+    variant = (assigned, limit, cursor, tuple(fields))
+    cachedResponse = responseCache.get('psyche_registereddevices', variant)
+    if cachedResponse:
+        return conditionalResponse(cachedResponse)
+    tableVersion = responseCache.version('psyche_registereddevices')
+
     try: 
-        with engine.connect() as connection: 
-            deviceInformationQuery = text('SELECT * FROM psyche_registereddevices;')
-            deviceInformationResult = connection.execute(deviceInformationQuery).fetchall()
+        with getEngine().connect() as connection: 
+            filters = []
+            if assigned == 'true':
+                filters.append("devassigned IS NOT NULL AND devassigned <> 'None'")
+            elif assigned == 'false':
+                filters.append("(devassigned IS NULL OR devassigned = 'None')")
+            rows, headers = listPage(
+                connection, 'psyche_registereddevices', 'devid', [deviceFields[field] for field in fields], filters, {}, limit, cursor
+            )
 
-            deviceInfoList = [
-                {
-                    "devType": str(device[0]),
-                    "devID": str(device[1]),
-                    "assignedTo": str(device[5]),
-                    "lastAssigned": str(device[3]),
-                    "battery": str(device[4])
-                } for device in deviceInformationResult
-            ]
+            deviceInfoList = [{field: str(row[deviceFields[field]]) for field in fields} for row in rows]
 
-            return jsonify(deviceInfoList), 200  
+            return conditionalResponse(responseCache.put('psyche_registereddevices', tableVersion, deviceInfoList, variant, headers))
 
     except Exception as e: 
         return jsonify({"message": "Error processing request:" + str(e)}), 500
@@ -492,7 +872,7 @@ def add_device():
     devBattery = 100
     
     try: 
-        with engine.connect() as connection: 
+        with getEngine().connect() as connection: 
             
             checkIDQuery = text("""
                 SELECT devid 
@@ -517,21 +897,87 @@ def add_device():
             }
             
             connection.execute(deviceEntryQuery, deviceEntryValues)
+            deviceAssignments.invalidate([devID])
+            liveVitals.forget([devID])
+            responseCache.invalidate('psyche_registereddevices')
             
             return jsonify({}), 200
         
     except Exception as e: 
         return jsonify({"message": "Error processing request:" + str(e)}), 500
     
+@app.route('/register-devices', methods=['POST'])
+def add_devices():
+    data = request.json
+    devices = data.get('devices') or []
+    if not isinstance(devices, list) or not all(isinstance(device, dict) for device in devices):
+        return jsonify({"message": "devices must be a list of objects."}), 400
+    devAssignedTime = datetime.now()
+
+    results = []
+    deviceEntryValues = []
+    for device in devices:
+        devID = device.get('devID')
+        result = {"devID": devID, "status": "registered"}
+        results.append(result)
+        if not devID:
+            result.update(status="rejected", message="Missing device ID")
+            continue
+        deviceEntryValues.append((result, {
+            'devtype': device.get('devType'),
+            'devid': devID,
+            'devassigned': 'None',
+            'lastassignment': devAssignedTime,
+            'devbattery': 100
+        }))
+
+    try:
+        with getEngine().begin() as connection:
+            usedIDs = set()
+            if deviceEntryValues:
+                checkIDQuery = text("""
+                    SELECT devid
+                    FROM psyche_registereddevices
+                    WHERE devid IN :devids
+                """).bindparams(bindparam('devids', expanding=True))
+                usedIDs = {row[0] for row in connection.execute(checkIDQuery, {'devids': [values['devid'] for _, values in deviceEntryValues]})}
+
+            acceptedValues = []
+            for result, values in deviceEntryValues:
+                if values['devid'] in usedIDs:
+                    result.update(status="rejected", message="Device ID already in use")
+                    continue
+                usedIDs.add(values['devid'])
+                acceptedValues.append(values)
+
+            if acceptedValues:
+                deviceEntryQuery = text('''
+                    INSERT INTO psyche_registereddevices (devtype, devid, devassigned, lastassignment, devbattery)
+                    VALUES (:devtype, :devid, :devassigned, :lastassignment, :devbattery)
+                ''')
+                connection.execute(deviceEntryQuery, acceptedValues)
+                acceptedIDs = [values['devid'] for values in acceptedValues]
+                deviceAssignments.invalidate(acceptedIDs)
+                liveVitals.forget(acceptedIDs)
+                responseCache.invalidate('psyche_registereddevices')
+
+            return jsonify({"results": results}), 200
+
+    except Exception as e:
+        return jsonify({"message": "Error processing request: " + str(e)}), 500
+
 @app.route('/remove-device', methods=['POST'])
 def remove_device(): 
     data = request.json
     devID = data.get('devID')
     
     try: 
-        with engine.connect() as connection: 
+        with getEngine().connect() as connection: 
             deviceRemovalQuery = text("DELETE FROM psyche_registereddevices WHERE devid = :devid")
             connection.execute(deviceRemovalQuery, {'devid': devID})
+            deviceAssignments.invalidate([devID])
+            liveVitals.forget([devID])
+            responseCache.invalidate('psyche_registereddevices')
             
             return jsonify({}), 200
     
@@ -544,7 +990,7 @@ def get_assignment_info():
     ptID = data.get('ptID')
 
     try:
-        with engine.connect() as connection:
+        with getEngine().connect() as connection:
             patientInfoQuery = text("""
                 SELECT pi.ptName, rd.devid, rd.devtype
                 FROM psychepatientinfo pi
@@ -575,7 +1021,7 @@ def swap_device():
     ptName = data.get('ptName')
     
     try: 
-        with engine.connect() as connection: 
+        with getEngine().connect() as connection: 
             if oldDevID != 'None': 
                 deviceDeleteQuery = text("UPDATE psyche_registereddevices SET devassigned = 'None', devassignedname = 'None' WHERE devid = :devid")
                 connection.execute(deviceDeleteQuery, {'devid': oldDevID})
@@ -587,12 +1033,141 @@ def swap_device():
                 'devid': newDevID,
             }
             connection.execute(deviceAssignQuery, deviceAssignValues)
+            deviceAssignments.invalidate([oldDevID, newDevID])
+            liveVitals.forget([oldDevID, newDevID])
+            responseCache.invalidate('psyche_registereddevices')
             
             return jsonify({}), 200
             
     except Exception as e: 
         return jsonify({"mesage": "Error processing request:" + str(e)}), 500
-    
+
+@app.route('/swap-devices', methods=['POST'])
+def swap_devices():
+    data = request.json
+    swaps = data.get('swaps') or []
+    if not isinstance(swaps, list) or not all(isinstance(swap, dict) for swap in swaps):
+        return jsonify({"message": "swaps must be a list of objects."}), 400
+    lastAssignment = datetime.now()
+
+    results = [{"newDevID": swap.get('newDevID'), "status": "assigned"} for swap in swaps]
+
+    try:
+        with getEngine().begin() as connection:
+            devIDs = {swap.get(field) for swap in swaps for field in ('newDevID', 'oldDevID')} - {None, 'None'}
+            registeredDevices = {}
+            if devIDs:
+                checkIDQuery = text("""
+                    SELECT devid, devassigned
+                    FROM psyche_registereddevices
+                    WHERE devid IN :devids
+                """).bindparams(bindparam('devids', expanding=True))
+                registeredDevices = {devid: devassigned for devid, devassigned in connection.execute(checkIDQuery, {'devids': list(devIDs)})}
+
+            ptIDs = {swap.get('ptID') for swap in swaps} - {None}
+            enrolledIDs = set()
+            if ptIDs:
+                checkPatientQuery = text("""
+                    SELECT ptid
+                    FROM psychepatientinfo
+                    WHERE ptid IN :ptids
+                """).bindparams(bindparam('ptids', expanding=True))
+                enrolledIDs = {row[0] for row in connection.execute(checkPatientQuery, {'ptids': list(ptIDs)})}
+
+            acceptedSwaps = []
+            for swap, result in zip(swaps, results):
+                newDevID = swap.get('newDevID')
+                oldDevID = swap.get('oldDevID', 'None')
+                if newDevID not in registeredDevices:
+                    result.update(status="rejected", message="Device is not registered")
+                elif swap.get('ptID') not in enrolledIDs:
+                    result.update(status="rejected", message="Patient is not enrolled")
+                elif oldDevID not in (None, 'None') and (oldDevID == newDevID or registeredDevices.get(oldDevID) != swap.get('ptID')):
+                    result.update(status="rejected", message="Old device is not assigned to this patient")
+                elif any(acceptedSwap.get('newDevID') == newDevID for acceptedSwap, _ in acceptedSwaps):
+                    result.update(status="rejected", message="Device is assigned twice in this request")
+                else:
+                    acceptedSwaps.append((swap, result))
+
+            while True:
+                releasedIDs = {swap.get('oldDevID', 'None') for swap, _ in acceptedSwaps}
+                blockedSwaps = [
+                    (swap, result) for swap, result in acceptedSwaps
+                    if registeredDevices[swap.get('newDevID')] not in (None, 'None', swap.get('ptID')) and swap.get('newDevID') not in releasedIDs
+                ]
+                if not blockedSwaps:
+                    break
+                for swap, result in blockedSwaps:
+                    result.update(status="rejected", message="Device is assigned to another patient")
+                acceptedSwaps = [(swap, result) for swap, result in acceptedSwaps if result['status'] == "assigned"]
+
+            deviceReleaseValues = [{'devid': swap.get('oldDevID')} for swap, _ in acceptedSwaps if swap.get('oldDevID', 'None') != 'None']
+            deviceAssignValues = [
+                {
+                    'devassigned': swap.get('ptID'),
+                    'devassignedname': swap.get('ptName'),
+                    'lastassignment': lastAssignment,
+                    'devid': swap.get('newDevID')
+                }
+                for swap, _ in acceptedSwaps
+            ]
+
+            if deviceReleaseValues:
+                deviceDeleteQuery = text("UPDATE psyche_registereddevices SET devassigned = 'None', devassignedname = 'None' WHERE devid = :devid")
+                connection.execute(deviceDeleteQuery, deviceReleaseValues)
+            if deviceAssignValues:
+                deviceAssignQuery = text("UPDATE psyche_registereddevices SET devassigned = :devassigned, devassignedname = :devassignedname, lastassignment = :lastassignment WHERE devid = :devid")
+                connection.execute(deviceAssignQuery, deviceAssignValues)
+
+            changedIDs = [values['devid'] for values in deviceReleaseValues + deviceAssignValues]
+            if changedIDs:
+                deviceAssignments.invalidate(changedIDs)
+                liveVitals.forget(changedIDs)
+                responseCache.invalidate('psyche_registereddevices')
+
+            return jsonify({"results": results}), 200
+
+    except Exception as e:
+        return jsonify({"message": "Error processing request: " + str(e)}), 500
+
+def getEngine():
+    global engine
+    if engine is None:
+        with engineLock:
+            if engine is None:
+                engineOptions = {}
+                if os.getenv('POSTGRES_URL', '').startswith('postgres'):
+                    engineOptions.update(
+                        executemany_mode='batch',
+                        executemany_batch_page_size=500,
+                        connect_args={'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', 10)), 'application_name': 'psyche-api'}
+                    )
+                    if os.getenv('DB_POOLER', '').lower() == 'pgbouncer':
+                        engineOptions.update(poolclass=NullPool)
+                    else:
+                        engineOptions.update(
+                            poolclass=TimedQueuePool,
+                            pool_size=int(os.getenv('DB_POOL_SIZE', 5)),
+                            max_overflow=int(os.getenv('DB_MAX_OVERFLOW', 10)),
+                            pool_timeout=float(os.getenv('DB_POOL_TIMEOUT', 30)),
+                            pool_recycle=int(os.getenv('DB_POOL_RECYCLE', 1800)),
+                            pool_pre_ping=os.getenv('DB_POOL_PRE_PING', 'true').lower() != 'false'
+                        )
+                engine = create_engine(os.getenv('POSTGRES_URL'), **engineOptions)
+                event.listen(engine, 'before_cursor_execute', metrics.beforeQuery)
+                event.listen(engine, 'after_cursor_execute', metrics.afterQuery)
+    return engine
+
+def getSMTPConfig():
+    return {
+        'host': os.getenv('SMTP_HOST'),
+        'port': int(os.getenv('SMTP_PORT')), 
+        'user': os.getenv('SMTP_USER'),
+        'password': os.getenv('SMTP_PASSWORD'),
+        'sender': os.getenv('SMTP_FROM', os.getenv('SMTP_USER')),
+        'starttls': os.getenv('SMTP_STARTTLS', 'true').lower() in ('1', 'true', 'yes')
+    }
+
 def hashPassword(entered_password, storedSalt):
     if not entered_password or not storedSalt:
         return None
@@ -607,25 +1182,1986 @@ def generateSaltedPassword(password):
     hashedPassword = hashlib.sha256(saltedPassword.encode()).hexdigest()
     return salt, hashedPassword
         
-def deviceBatteries():
-    fetchBatteryLevelsQuery = text("""
-        SELECT devID, battery
-        FROM (
-            SELECT devID, battery,
-                   ROW_NUMBER() OVER(PARTITION BY devID ORDER BY timestamp DESC) AS rn
-            FROM psyche_patientdata
-        ) ranked
-        WHERE rn = 1
+def formatDeviceID(devID):
+    return f"ST-{'0' if int(devID) < 10 else ''}{devID}"
+
+def isAssigned(ptid, ptname):
+    return bool((ptid and ptid != 'None') and (ptname and ptname != 'None'))
+
+def parseDeviceTimestamp(value):
+    try:
+        epochSeconds = float(value)
+    except ValueError:
+        timestamp = datetime.fromisoformat(value)
+        if timestamp.tzinfo is not None:
+            timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+        return timestamp
+    return datetime.utcfromtimestamp(epochSeconds)
+
+sampleNumberFields = ['accX', 'accY', 'accZ', 'gyroX', 'gyroY', 'gyroZ', 'hr', 'battery']
+
+def parseBatchSample(dataArray):
+    dataArray = [value.strip() for value in dataArray]
+    if len(dataArray) != len(sampleFields) or not dataArray[1].isdigit():
+        raise ValueError('Malformed sample')
+
+    data = dict(zip(sampleFields, dataArray))
+    data['timestamp'] = parseDeviceTimestamp(data['timestamp'])
+    data.update(parseSampleNumbers(data))
+    return data
+
+def parseSampleNumbers(data):
+    sampleNumbers = {field: float(data[field]) for field in sampleNumberFields}
+    sampleNumbers['presence'] = int(data['presence'])
+    return sampleNumbers
+
+binaryFrameMimetype = 'application/x-psyche-frames'
+binaryFrameFields = [
+    ('timestamp', '<f8'),
+    ('devID', '<u2'),
+    ('accX', '<f4'),
+    ('accY', '<f4'),
+    ('accZ', '<f4'),
+    ('gyroX', '<f4'),
+    ('gyroY', '<f4'),
+    ('gyroZ', '<f4'),
+    ('hr', '<f4'),
+    ('presence', 'u1'),
+    ('battery', '<f4')
+]
+minFrameEpoch = (datetime.min - datetime(1970, 1, 1)).total_seconds()
+maxFrameEpoch = (datetime.max - datetime(1970, 1, 1)).total_seconds()
+
+def decodeFrames(body):
+    import numpy as np
+
+    frameDtype = np.dtype(binaryFrameFields)
+    if len(body) % frameDtype.itemsize:
+        raise ValueError(f"Binary frames must be a multiple of {frameDtype.itemsize} bytes.")
+
+    frames = np.frombuffer(body, dtype=frameDtype)
+    epochSeconds = frames['timestamp']
+    with np.errstate(invalid='ignore'):
+        valid = np.isfinite(epochSeconds) & (epochSeconds >= minFrameEpoch) & (epochSeconds < maxFrameEpoch)
+    frameIndexes = np.flatnonzero(valid)
+    frames = frames[valid]
+
+    columns = {field: frames[field].tolist() for field, _ in binaryFrameFields[2:]}
+    columns['timestamp'] = (frames['timestamp'] * 1e6).astype('datetime64[us]').tolist()
+    columns['devID'] = [str(devID) for devID in frames['devID'].tolist()]
+    samples = [dict(zip(sampleFields, values)) for values in zip(*(columns[field] for field in sampleFields))]
+    return list(zip(frameIndexes.tolist(), samples)), np.flatnonzero(~valid).tolist()
+
+def patientDataRow(ptid, ptname, data):
+    return {
+        'ptid': ptid, 
+        'ptname': ptname, 
+        'timestamp': data['timestamp'], 
+        'devid': data['devID'], 
+        'accx': data['accX'],  
+        'accy': data['accY'], 
+        'accz': data['accZ'], 
+        'gyrox': data['gyroX'], 
+        'gyroy': data['gyroY'], 
+        'gyroz': data['gyroZ'], 
+        'hr': data['hr'], 
+        'presence': data['presence'], 
+        'battery': data['battery']
+    }
+
+def insertPatientData(connection, patientDataRows):
+    if not patientDataRows:
+        return
+
+    dataInsertQuery = text('''
+        INSERT INTO psyche_patientdata
+        (ptid, ptname,  timestamp, devid, accx, accy, accz, gyrox, gyroy, gyroz, hr, presence, battery)
+        VALUES (:ptid, :ptname,  :timestamp, :devid, :accx, :accy, :accz, :gyrox, :gyroy, :gyroz, :hr, :presence, :battery)
+    ''')
+    connection.execute(dataInsertQuery, patientDataRows)
+    updateSessionSummaries(connection, patientDataRows)
+
+def updateSessionSummaries(connection, patientDataRows):
+    sessionSummaries = {}
+    for row in patientDataRows:
+        rowBytes = len(','.join(str(value) for value in row.values()).encode('utf-8')) + 2
+        summary = sessionSummaries.get(row['ptid'])
+        if summary is None:
+            sessionSummaries[row['ptid']] = {
+                'ptid': row['ptid'],
+                'ptname': row['ptname'],
+                'rowcount': 1,
+                'sizebytes': rowBytes,
+                'firsttimestamp': row['timestamp'],
+                'lasttimestamp': row['timestamp']
+            }
+        else:
+            summary['rowcount'] += 1
+            summary['sizebytes'] += rowBytes
+            summary['firsttimestamp'] = min(summary['firsttimestamp'], row['timestamp'])
+            summary['lasttimestamp'] = max(summary['lasttimestamp'], row['timestamp'])
+
+    sessionUpsertQuery = text('''
+        INSERT INTO psyche_sessionsummary (ptid, ptname, rowcount, sizebytes, firsttimestamp, lasttimestamp)
+        VALUES (:ptid, :ptname, :rowcount, :sizebytes, :firsttimestamp, :lasttimestamp)
+        ON CONFLICT (ptid) DO UPDATE SET
+            rowcount = psyche_sessionsummary.rowcount + excluded.rowcount,
+            sizebytes = psyche_sessionsummary.sizebytes + excluded.sizebytes,
+            firsttimestamp = CASE WHEN excluded.firsttimestamp < psyche_sessionsummary.firsttimestamp
+                THEN excluded.firsttimestamp ELSE psyche_sessionsummary.firsttimestamp END,
+            lasttimestamp = CASE WHEN excluded.lasttimestamp > psyche_sessionsummary.lasttimestamp
+                THEN excluded.lasttimestamp ELSE psyche_sessionsummary.lasttimestamp END
+    ''')
+    connection.execute(sessionUpsertQuery, [sessionSummaries[ptid] for ptid in sorted(sessionSummaries)])
+
+sessionRowSize = "octet_length(concat_ws(',', ptid, ptname, timestamp, devid, accx, accy, accz, gyrox, gyroy, gyroz, hr, presence, battery)) + 2"
+
+def refreshSessionSummaries(connection):
+    connection.execute(text('DELETE FROM psyche_sessionsummary'))
+    connection.execute(text(f'''
+        INSERT INTO psyche_sessionsummary (ptid, ptname, rowcount, sizebytes, firsttimestamp, lasttimestamp)
+        SELECT ptid, MIN(ptname), COUNT(*), SUM({sessionRowSize}), MIN(timestamp), MAX(timestamp)
+        FROM psyche_patientdata
+        GROUP BY ptid
+    '''))
+
+def expireSessionSummaries(connection, expiredRows):
+    expiredSummaries = {}
+    for ptid, rowcount, sizebytes, lasttimestamp in expiredRows:
+        summary = expiredSummaries.setdefault(ptid, {'ptid': ptid, 'rowcount': 0, 'sizebytes': 0, 'lasttimestamp': lasttimestamp})
+        summary['rowcount'] += rowcount
+        summary['sizebytes'] += sizebytes or 0
+        summary['lasttimestamp'] = max(summary['lasttimestamp'], lasttimestamp)
+    if not expiredSummaries:
+        return
+
+    sessionExpireQuery = text('''
+        UPDATE psyche_sessionsummary
+        SET rowcount = rowcount - :rowcount,
+            sizebytes = GREATEST(sizebytes - :sizebytes, 0),
+            firsttimestamp = GREATEST(firsttimestamp, :lasttimestamp)
+        WHERE ptid = :ptid
+    ''')
+    connection.execute(sessionExpireQuery, [expiredSummaries[ptid] for ptid in sorted(expiredSummaries)])
+    connection.execute(text('DELETE FROM psyche_sessionsummary WHERE rowcount <= 0'))
+
+exportChunkRows = int(os.getenv('EXPORT_CHUNK_ROWS', 5000))
+
+class PatientExport:
+    def __init__(self, ptID, chunkRows=exportChunkRows, ordered=False):
+        self.ptID = ptID
+        self.chunkRows = chunkRows
+        self.connection = getEngine().connect()
+        if self.connection.dialect.name == 'postgresql':
+            self.connection = self.connection.execution_options(isolation_level='REPEATABLE READ')
+        self.transaction = self.connection.begin()
+        try:
+            patientDataQuery = text('SELECT * FROM psyche_patientdata WHERE ptid = :ptid' + (' ORDER BY timestamp' if ordered else ''))
+            self.result = self.connection.execution_options(stream_results=True).execute(patientDataQuery, {'ptid': ptID})
+            self.columns = list(self.result.keys())
+            self.firstRows = self.result.fetchmany(chunkRows)
+        except Exception:
+            self.close()
+            raise
+
+    def chunks(self):
+        rows = self.firstRows
+        while rows:
+            yield rows
+            rows = self.result.fetchmany(self.chunkRows)
+
+    def complete(self):
+        patientDeleteQuery = text('DELETE FROM psyche_patientdata WHERE ptid = :ptid')
+        deletedRows = self.connection.execute(patientDeleteQuery, {'ptid': self.ptID}).rowcount
+        self.transaction.commit()
+
+        sessionUpdateQuery = text('''
+            UPDATE psyche_sessionsummary
+            SET sizebytes = CASE WHEN rowcount > :rowcount THEN sizebytes * (rowcount - :rowcount) / rowcount ELSE 0 END,
+                rowcount = rowcount - :rowcount
+            WHERE ptid = :ptid
+        ''')
+        self.connection.execute(sessionUpdateQuery, {'ptid': self.ptID, 'rowcount': deletedRows})
+        sessionDeleteQuery = text('DELETE FROM psyche_sessionsummary WHERE ptid = :ptid AND rowcount <= 0')
+        self.connection.execute(sessionDeleteQuery, {'ptid': self.ptID})
+
+    def close(self):
+        if self.transaction.is_active:
+            self.transaction.rollback()
+        self.connection.close()
+
+def streamPatientExport(export, encodedChunks):
+    try:
+        yield from encodedChunks
+        export.complete()
+    finally:
+        export.close()
+
+def csvChunks(columns, rowChunks):
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow(columns)
+    for rows in rowChunks:
+        writer.writerows(rows)
+        yield output.getvalue().encode('utf-8')
+        output.seek(0)
+        output.truncate(0)
+
+def gzipChunks(encodedChunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in encodedChunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+exportColumnTypes = {
+    'timestamp': 'datetime64[ms]',
+    'devid': 'int16',
+    'accx': 'float32',
+    'accy': 'float32',
+    'accz': 'float32',
+    'gyrox': 'float32',
+    'gyroy': 'float32',
+    'gyroz': 'float32',
+    'hr': 'float32',
+    'presence': 'int8',
+    'battery': 'float32'
+}
+exportPatientColumns = ('ptid', 'ptname')
+
+class ZipStream:
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+def npzChunks(columns, rowChunks, blockBytes=1 << 20):
+    import numpy as np
+
+    columnFiles = {column: tempfile.TemporaryFile() for column in columns if column not in exportPatientColumns}
+    patientValues = {}
+    rowCount = 0
+    try:
+        for rows in rowChunks:
+            for column, values in zip(columns, zip(*rows)):
+                if column in exportPatientColumns:
+                    patientValues.setdefault(column, values[0])
+                else:
+                    columnFiles[column].write(np.asarray(values, dtype=exportColumnTypes.get(column, 'float64')).tobytes())
+            rowCount += len(rows)
+
+        stream = ZipStream()
+        with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for column, value in patientValues.items():
+                with archive.open(f'{column}.npy', 'w') as entry:
+                    np.lib.format.write_array(entry, np.array(str(value)))
+
+            for column, columnFile in columnFiles.items():
+                header = {
+                    'descr': np.lib.format.dtype_to_descr(np.dtype(exportColumnTypes.get(column, 'float64'))),
+                    'fortran_order': False,
+                    'shape': (rowCount,)
+                }
+                columnFile.seek(0)
+                with archive.open(f'{column}.npy', 'w', force_zip64=True) as entry:
+                    np.lib.format.write_array_header_1_0(entry, header)
+                    while True:
+                        block = columnFile.read(blockBytes)
+                        if not block:
+                            break
+                        entry.write(block)
+                        yield stream.drain()
+        yield stream.drain()
+    finally:
+        for columnFile in columnFiles.values():
+            columnFile.close()
+
+exportBundleWorkers = int(os.getenv('EXPORT_BUNDLE_WORKERS', 4))
+
+def bundleEntryName(name):
+    return ''.join('_' if character in '/\\' or ord(character) < 32 else character for character in name).lstrip('.')
+
+def exportBundle(ptIDs, exportFormat, blockBytes=1 << 20):
+    from concurrent.futures import ThreadPoolExecutor
+
+    finished = queue.Queue()
+    cancelled = threading.Event()
+
+    def exportPatient(ptID):
+        handoff = {'written': threading.Event(), 'done': threading.Event(), 'keep': False, 'error': None}
+        export = None
+        entryFile = None
+        try:
+            if cancelled.is_set():
+                return
+            export = PatientExport(ptID)
+            if not export.firstRows:
+                finished.put((ptID, None, None, 0, None, None))
+                return
+
+            rowCounts = []
+            def countedChunks():
+                for rows in export.chunks():
+                    rowCounts.append(len(rows))
+                    yield rows
+
+            entryFile = tempfile.TemporaryFile()
+            encoder = npzChunks if exportFormat == 'npz' else csvChunks
+            for chunk in encoder(export.columns, countedChunks()):
+                entryFile.write(chunk)
+            entryFile.seek(0)
+            ptName = export.firstRows[0][export.columns.index('ptname')]
+            finished.put((ptID, ptName, entryFile, sum(rowCounts), None, handoff))
+
+            while not handoff['written'].wait(1):
+                if cancelled.is_set():
+                    return
+            if handoff['keep']:
+                export.complete()
+        except Exception as e:
+            if not handoff['written'].is_set():
+                finished.put((ptID, None, None, 0, e, None))
+            handoff['error'] = e
+        finally:
+            if export is not None:
+                export.close()
+            handoff['done'].set()
+
+    executor = ThreadPoolExecutor(exportBundleWorkers)
+    try:
+        for ptID in ptIDs:
+            executor.submit(copy_current_request_context(exportPatient) if has_request_context() else exportPatient, ptID)
+
+        stream = ZipStream()
+        results = []
+        with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            for _ in ptIDs:
+                ptID, ptName, entryFile, rowCount, error, handoff = finished.get()
+                result = {"ptID": ptID}
+                results.append(result)
+                if error is not None:
+                    result.update(status="failed", message=str(error))
+                    continue
+                if handoff is None:
+                    result.update(status="empty")
+                    continue
+
+                try:
+                    entryInfo = zipfile.ZipInfo(bundleEntryName(f'{ptName}-{ptID}_RTData.{exportFormat}'), datetime.utcnow().timetuple()[:6])
+                    entryInfo.compress_type = zipfile.ZIP_STORED if exportFormat == 'npz' else zipfile.ZIP_DEFLATED
+                    with archive.open(entryInfo, 'w', force_zip64=True) as entry:
+                        while True:
+                            block = entryFile.read(blockBytes)
+                            if not block:
+                                break
+                            entry.write(block)
+                            yield stream.drain()
+                    yield stream.drain()
+                    handoff['keep'] = True
+                finally:
+                    entryFile.close()
+                    handoff['written'].set()
+
+                handoff['done'].wait()
+                if handoff['error'] is not None:
+                    result.update(status="failed", message=str(handoff['error']))
+                else:
+                    result.update(status="exported", file=entryInfo.filename, rows=rowCount)
+            archive.writestr('manifest.json', json.dumps({"exportedAt": datetime.utcnow().isoformat(), "patients": results}, indent=2))
+        yield stream.drain()
+    finally:
+        cancelled.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        while not finished.empty():
+            entryFile = finished.get()[2]
+            if entryFile is not None:
+                entryFile.close()
+
+def formatTimestamp(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+maxRawPoints = 10000
+maxBucketPoints = 10000
+bucketColumns = ['accx', 'accy', 'accz', 'gyrox', 'gyroy', 'gyroz', 'hr']
+
+def patientDataBuckets(connection, ptID, startTimestamp, endTimestamp, resolution):
+    bucketAggregates = ',\n'.join(
+        f'AVG({column}) AS {column}_mean, MIN({column}) AS {column}_min, MAX({column}) AS {column}_max'
+        for column in bucketColumns
+    )
+    bucketQuery = text(f'''
+        SELECT to_timestamp(floor(extract(epoch FROM timestamp) / :resolution) * :resolution) AT TIME ZONE 'UTC' AS bucket,
+               COUNT(*) AS samples,
+               AVG(presence) AS presence,
+               {bucketAggregates}
+        FROM psyche_patientdata
+        WHERE ptid = :ptid AND timestamp >= :start AND timestamp < :end
+        GROUP BY bucket
+        ORDER BY bucket
+    ''')
+    bucketResult = connection.execute(bucketQuery, {'ptid': ptID, 'start': startTimestamp, 'end': endTimestamp, 'resolution': resolution})
+
+    return [
+        {
+            "timestamp": formatTimestamp(row['bucket']),
+            "samples": int(row['samples']),
+            "presence": toFloat(row['presence']),
+            **{
+                column: {
+                    "mean": toFloat(row[f'{column}_mean']),
+                    "min": toFloat(row[f'{column}_min']),
+                    "max": toFloat(row[f'{column}_max'])
+                } for column in bucketColumns
+            }
+        } for row in bucketResult
+    ]
+
+rowRefPattern = re.compile(r'\(\d+,\d+\)')
+
+def patientDataPage(connection, ptID, startTimestamp, endTimestamp, limit, cursor=None):
+    pageValues = {'ptid': ptID, 'start': startTimestamp, 'end': endTimestamp, 'limit': limit}
+    cursorFilter = ''
+    if cursor:
+        afterTimestamp, afterRow = decodePageCursor(cursor)
+        pageValues.update(afterTimestamp=afterTimestamp, afterRow=afterRow)
+        cursorFilter = 'AND (timestamp, ctid) > (:afterTimestamp, CAST(:afterRow AS tid))'
+
+    pageQuery = text(f'''
+        SELECT ctid::text AS rowref, timestamp, devid, accx, accy, accz, gyrox, gyroy, gyroz, hr, presence, battery
+        FROM psyche_patientdata
+        WHERE ptid = :ptid AND timestamp >= :start AND timestamp < :end
+        {cursorFilter}
+        ORDER BY timestamp, ctid
+        LIMIT :limit
+    ''')
+    rows = connection.execute(pageQuery, pageValues).fetchall()
+
+    points = [
+        {
+            "timestamp": formatTimestamp(row['timestamp']),
+            "devID": str(row['devid']),
+            **{column: toFloat(row[column]) for column in bucketColumns},
+            "presence": toFloat(row['presence']),
+            "battery": toFloat(row['battery'])
+        } for row in rows
+    ]
+
+    nextCursor = None
+    if len(rows) == limit:
+        lastRow = rows[-1]
+        nextCursor = base64.urlsafe_b64encode(json.dumps([formatTimestamp(lastRow['timestamp']), lastRow['rowref']]).encode()).decode()
+    return points, nextCursor
+
+def decodePageCursor(cursor):
+    if not isinstance(cursor, str):
+        raise TypeError('Cursor must be a string')
+    afterTimestamp, afterRow = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if not isinstance(afterTimestamp, str) or not isinstance(afterRow, str) or not rowRefPattern.fullmatch(afterRow):
+        raise ValueError('Malformed cursor')
+    return parseDeviceTimestamp(afterTimestamp), afterRow
+
+def toFloat(value):
+    return float(value) if value is not None else None
+
+def queuePatientData(connection, patientDataRows):
+    maintainPartitions()
+    if ingestBuffer is None:
+        insertPatientData(connection, patientDataRows)
+        return True
+    return ingestBuffer.put(patientDataRows)
+
+def publishSamples(liveSamples):
+    for devid, ptid, ptname, data in liveSamples:
+        liveVitals.record(devid, ptid, ptname, data)
+        liveBroker.publish(devid, ptid, ptname, data)
+        patientRollups.add(ptid, data)
+    patientRollups.flushRequest()
+
+batteryLevels = {}
+batteryLock = threading.Lock()
+batteryWriteInterval = float(os.getenv('BATTERY_WRITE_INTERVAL', 60))
+
+def updateDeviceBatteries(connection, latestBatteries):
+    now = time.monotonic()
+    with batteryLock:
+        pendingBatteries = {
+            devid: battery for devid, battery in latestBatteries.items()
+            if devid not in batteryLevels
+            or batteryLevels[devid][0] != battery
+            or now - batteryLevels[devid][1] >= batteryWriteInterval
+        }
+
+    if not pendingBatteries:
+        return
+
+    updateBatteryQuery = text("""
+        UPDATE psyche_registereddevices
+        SET devbattery = :devbattery
+        WHERE devid = :devid;
     """)
+    connection.execute(updateBatteryQuery, [{'devbattery': battery, 'devid': devid} for devid, battery in pendingBatteries.items()])
+    responseCache.invalidate('psyche_registereddevices')
+
+    with batteryLock:
+        for devid, battery in pendingBatteries.items():
+            batteryLevels[devid] = (battery, now)
+
+class DeviceAssignmentCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def getMany(self, connection, devids):
+        now = time.monotonic()
+        assignments = {}
+        missingDevids = []
+        with self.lock:
+            generation = self.generation
+            for devid in devids:
+                entry = self.entries.get(devid)
+                if entry and entry[1] > now:
+                    assignments[devid] = entry[0]
+                    self.hits += 1
+                else:
+                    missingDevids.append(devid)
+                    self.misses += 1
+
+        if not missingDevids:
+            return assignments
+
+        assignmentQuery = text("""
+            SELECT devid, devassigned, devassignedname
+            FROM psyche_registereddevices
+            WHERE devid IN :devids
+        """).bindparams(bindparam('devids', expanding=True))
+        foundAssignments = {
+            devid: (ptid, ptname) for devid, ptid, ptname in connection.execute(assignmentQuery, {'devids': missingDevids})
+        }
+
+        with self.lock:
+            for devid in missingDevids:
+                assignments[devid] = foundAssignments.get(devid)
+                if generation == self.generation:
+                    self.entries[devid] = (assignments[devid], now + self.ttl)
+        return assignments
+
+    def invalidate(self, devids=None):
+        with self.lock:
+            self.generation += 1
+            self.invalidations += 1
+            if devids is None:
+                self.entries.clear()
+            else:
+                for devid in devids:
+                    self.entries.pop(devid, None)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "ttlSeconds": self.ttl
+            }
 
-    with engine.connect() as connection:
-        recentBatteryLevels = connection.execute(fetchBatteryLevelsQuery).fetchall()
-        for devID, battery in recentBatteryLevels:
-            if devID and battery is not None:
-                devIDFormatted = f"ST-{'0' if int(devID) < 10 else ''}{devID}"
-                updateBatteryQuery = text("""
-                    UPDATE psyche_registereddevices
-                    SET devbattery = :devbattery
-                    WHERE devid = :devid;
-                """)
-                connection.execute(updateBatteryQuery, {'devbattery': battery, 'devid': devIDFormatted})
+deviceAssignments = DeviceAssignmentCache(float(os.getenv('DEVICE_CACHE_TTL', 5)))
+
+class IngestBuffer:
+    def __init__(self, capacity, batchSize, maxAge):
+        self.capacity = capacity
+        self.batchSize = batchSize
+        self.maxAge = maxAge
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.closed = False
+        self.flushedRows = 0
+        self.rejectedRows = 0
+        self.failedFlushes = 0
+
+    def put(self, patientDataRows):
+        if not patientDataRows:
+            return True
+
+        with self.condition:
+            if self.closed or len(self.pending) + len(patientDataRows) > self.capacity:
+                self.rejectedRows += len(patientDataRows)
+                return False
+
+            wasEmpty = not self.pending
+            enqueuedAt = time.monotonic()
+            self.pending.extend((enqueuedAt, row) for row in patientDataRows)
+            if wasEmpty or len(self.pending) >= self.batchSize:
+                self.condition.notify()
+
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='ingest-flusher', daemon=True)
+                self.thread.start()
+        return True
+
+    def nextBatch(self):
+        with self.condition:
+            while not self.closed and len(self.pending) < self.batchSize:
+                if self.pending:
+                    remaining = self.maxAge - (time.monotonic() - self.pending[0][0])
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                else:
+                    self.condition.wait()
+
+            return [self.pending.popleft()[1] for _ in range(min(self.batchSize, len(self.pending)))]
+
+    def run(self):
+        failures = 0
+        while True:
+            batch = self.nextBatch()
+            if not batch:
+                return
+
+            try:
+                with getEngine().begin() as connection:
+                    insertPatientData(connection, batch)
+                failures = 0
+                with self.condition:
+                    self.flushedRows += len(batch)
+            except Exception:
+                app.logger.exception("Failed to flush %d buffered samples", len(batch))
+                failures += 1
+                with self.condition:
+                    self.failedFlushes += 1
+                    if self.closed and failures >= 3:
+                        self.rejectedRows += len(batch)
+                        continue
+                    self.pending.extendleft((time.monotonic(), row) for row in reversed(batch))
+                time.sleep(min(2 ** failures, 30))
+
+    def close(self, timeout=30):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def stats(self):
+        with self.condition:
+            return {
+                "pending": len(self.pending),
+                "capacity": self.capacity,
+                "flushedRows": self.flushedRows,
+                "rejectedRows": self.rejectedRows,
+                "failedFlushes": self.failedFlushes
+            }
+
+ingestBuffer = None
+if os.getenv('INGEST_WRITE_BEHIND', '').lower() in ('1', 'true', 'yes'):
+    ingestBuffer = IngestBuffer(
+        int(os.getenv('INGEST_BUFFER_CAPACITY', 50000)),
+        int(os.getenv('INGEST_BATCH_SIZE', 1000)),
+        float(os.getenv('INGEST_MAX_AGE', 2))
+    )
+    atexit.register(ingestBuffer.close)
+
+schemaTables = [
+    '''
+    CREATE TABLE IF NOT EXISTS psyche_patientdata (
+        ptid TEXT NOT NULL,
+        ptname TEXT,
+        timestamp TIMESTAMP NOT NULL,
+        devid TEXT,
+        accx REAL,
+        accy REAL,
+        accz REAL,
+        gyrox REAL,
+        gyroy REAL,
+        gyroz REAL,
+        hr REAL,
+        presence INTEGER,
+        battery REAL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS psyche_registereddevices (
+        devtype TEXT,
+        devid TEXT NOT NULL,
+        devassigned TEXT,
+        lastassignment TIMESTAMP,
+        devbattery REAL,
+        devassignedname TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS psycheusers (
+        firstname TEXT,
+        lastname TEXT,
+        username TEXT NOT NULL,
+        email TEXT NOT NULL,
+        password TEXT,
+        hashedpassword TEXT,
+        salt TEXT,
+        image TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS psychepatientinfo (
+        ptid TEXT NOT NULL,
+        ptname TEXT,
+        ptsex TEXT,
+        ptage INTEGER,
+        pttag TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS psychepatientinfo_archive (
+        ptid TEXT,
+        ptname TEXT,
+        ptsex TEXT,
+        ptage INTEGER,
+        pttag TEXT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS psyche_resettokens (
+        username TEXT,
+        resettoken TEXT,
+        expirationtimestamp TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS psyche_sessionsummary (
+        ptid TEXT PRIMARY KEY,
+        ptname TEXT,
+        rowcount BIGINT NOT NULL DEFAULT 0,
+        sizebytes BIGINT NOT NULL DEFAULT 0,
+        firsttimestamp TIMESTAMP,
+        lasttimestamp TIMESTAMP
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS psyche_patientrollup (
+        ptid TEXT NOT NULL,
+        bucket TIMESTAMP NOT NULL,
+        samples BIGINT NOT NULL DEFAULT 0,
+        presentsamples BIGINT NOT NULL DEFAULT 0,
+        hrsum DOUBLE PRECISION NOT NULL DEFAULT 0,
+        hrcount BIGINT NOT NULL DEFAULT 0,
+        hrmax REAL,
+        activitysum DOUBLE PRECISION NOT NULL DEFAULT 0,
+        gyroenergysum DOUBLE PRECISION NOT NULL DEFAULT 0
+    )
+    '''
+]
+
+schemaIndexes = {
+    'psyche_patientdata_ptid_timestamp_idx': 'CREATE INDEX IF NOT EXISTS psyche_patientdata_ptid_timestamp_idx ON psyche_patientdata (ptid, timestamp)',
+    'psyche_registereddevices_devid_idx': 'CREATE UNIQUE INDEX IF NOT EXISTS psyche_registereddevices_devid_idx ON psyche_registereddevices (devid)',
+    'psyche_registereddevices_devassigned_idx': 'CREATE INDEX IF NOT EXISTS psyche_registereddevices_devassigned_idx ON psyche_registereddevices (devassigned)',
+    'psycheusers_username_idx': 'CREATE UNIQUE INDEX IF NOT EXISTS psycheusers_username_idx ON psycheusers (username)',
+    'psycheusers_email_idx': 'CREATE UNIQUE INDEX IF NOT EXISTS psycheusers_email_idx ON psycheusers (email)',
+    'psychepatientinfo_ptid_idx': 'CREATE UNIQUE INDEX IF NOT EXISTS psychepatientinfo_ptid_idx ON psychepatientinfo (ptid)',
+    'psychepatientinfo_archive_ptid_idx': 'CREATE INDEX IF NOT EXISTS psychepatientinfo_archive_ptid_idx ON psychepatientinfo_archive (ptid)',
+    'psyche_patientrollup_ptid_bucket_idx': 'CREATE UNIQUE INDEX IF NOT EXISTS psyche_patientrollup_ptid_bucket_idx ON psyche_patientrollup (ptid, bucket)',
+    'psyche_resettokens_username_idx': 'CREATE INDEX IF NOT EXISTS psyche_resettokens_username_idx ON psyche_resettokens (username, expirationtimestamp DESC)'
+}
+
+retiredIndexes = ['psyche_patientdata_devid_timestamp_idx']
+
+hotQueries = {
+    'export-sessions': (
+        'SELECT * FROM psyche_patientdata WHERE ptid = :ptid',
+        {'ptid': 'P0000'}
+    ),
+    'patient-data': (
+        '''
+        SELECT timestamp, devid, hr FROM psyche_patientdata
+        WHERE ptid = :ptid AND timestamp >= :start AND timestamp < :end
+        ORDER BY timestamp, ctid LIMIT 1000
+        ''',
+        {'ptid': 'P0000', 'start': datetime(2000, 1, 1), 'end': datetime(2000, 1, 2)}
+    ),
+    'device-assignment': (
+        'SELECT devid, devassigned, devassignedname FROM psyche_registereddevices WHERE devid = :devid',
+        {'devid': 'ST-01'}
+    ),
+    'assignment-info': (
+        '''
+        SELECT pi.ptName, rd.devid, rd.devtype
+        FROM psychepatientinfo pi
+        LEFT JOIN psyche_registereddevices rd ON pi.ptid = rd.devassigned AND rd.devassigned = :ptid
+        WHERE pi.ptid = :ptid
+        ''',
+        {'ptid': 'P0000'}
+    ),
+    'patient-id-check': (
+        'SELECT ptid FROM psychepatientinfo WHERE ptid = :ptid UNION SELECT ptid FROM psychepatientinfo_archive WHERE ptid = :ptid',
+        {'ptid': 'P0000'}
+    ),
+    'login': (
+        'SELECT salt, hashedpassword FROM psycheusers WHERE username = :username OR email = :username',
+        {'username': 'nobody'}
+    ),
+    'get-sessions': (
+        'SELECT ptid, ptname, rowcount, sizebytes FROM psyche_sessionsummary WHERE rowcount > 0 ORDER BY ptid',
+        {}
+    ),
+    'patient-rollups': (
+        'SELECT bucket, samples, hrsum, hrcount FROM psyche_patientrollup WHERE ptid = :ptid AND bucket >= :start AND bucket < :end',
+        {'ptid': 'P0000', 'start': datetime(2000, 1, 1), 'end': datetime(2000, 1, 8)}
+    )
+}
+
+partitionInterval = os.getenv('PATIENTDATA_PARTITION', 'day')
+partitionsAhead = int(os.getenv('PATIENTDATA_PARTITIONS_AHEAD', 7))
+partitionCheckInterval = float(os.getenv('PATIENTDATA_PARTITION_CHECK_INTERVAL', 3600))
+partitionLockTimeout = int(os.getenv('PATIENTDATA_PARTITION_LOCK_TIMEOUT_MS', 500))
+retentionDays = int(os.getenv('PATIENTDATA_RETENTION_DAYS', 0))
+lastPartitionCheck = None
+
+def usesPartitions(connection):
+    return connection.dialect.name == 'postgresql' and partitionInterval in ('day', 'week')
+
+def isPartitioned(connection):
+    partitionedQuery = text("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('psyche_patientdata')")
+    return connection.execute(partitionedQuery).first() is not None
+
+def partitionStart(value):
+    start = datetime(value.year, value.month, value.day)
+    if partitionInterval == 'week':
+        start -= timedelta(days=start.weekday())
+    return start
+
+def partitionEnd(start):
+    return start + timedelta(days=7 if partitionInterval == 'week' else 1)
+
+def partitionName(start):
+    return f"psyche_patientdata_p{start:%Y%m%d}"
+
+def createPartitions(connection, firstTimestamp, lastTimestamp):
+    existingPartitions = {name for name, _ in listPartitions(connection)}
+    hasDefault = connection.execute(text("SELECT to_regclass('psyche_patientdata_default')")).scalar() is not None
+    columns = ', '.join(patientDataColumns)
+    start = partitionStart(firstTimestamp)
+    createdPartitions = []
+    while start <= lastTimestamp:
+        end = partitionEnd(start)
+        name = partitionName(start)
+        if name not in existingPartitions:
+            bounds = f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+            rangeValues = {'start': start, 'end': end}
+            strayQuery = text('SELECT 1 FROM psyche_patientdata_default WHERE timestamp >= :start AND timestamp < :end LIMIT 1')
+            if hasDefault and connection.execute(strayQuery, rangeValues).first():
+                connection.execute(text(f'CREATE TABLE {name} (LIKE psyche_patientdata INCLUDING DEFAULTS)'))
+                connection.execute(text(f'''
+                    WITH moved AS (
+                        DELETE FROM psyche_patientdata_default WHERE timestamp >= :start AND timestamp < :end RETURNING {columns}
+                    )
+                    INSERT INTO {name} ({columns}) SELECT {columns} FROM moved
+                '''), rangeValues)
+                connection.execute(text(f'ALTER TABLE psyche_patientdata ATTACH PARTITION {name} {bounds}'))
+            else:
+                connection.execute(text(f'CREATE TABLE {name} PARTITION OF psyche_patientdata {bounds}'))
+            createdPartitions.append(name)
+        start = end
+    return createdPartitions
+
+def ensurePartitions(connection):
+    now = datetime.utcnow()
+    if connection.execute(text("SELECT to_regclass('psyche_patientdata_default')")).scalar() is None:
+        connection.execute(text('CREATE TABLE psyche_patientdata_default PARTITION OF psyche_patientdata DEFAULT'))
+    return createPartitions(connection, now, partitionEnd(partitionStart(now)) + timedelta(days=partitionsAhead))
+
+def splitDefaultPartition(connection, earliestTimestamp):
+    strayQuery = text('SELECT MIN(timestamp), MAX(timestamp) FROM psyche_patientdata_default WHERE timestamp >= :earliest')
+    bounds = connection.execute(strayQuery, {'earliest': earliestTimestamp}).first()
+    if bounds[0] is None:
+        return []
+    return createPartitions(connection, bounds[0], bounds[1])
+
+def listPartitions(connection):
+    partitionQuery = text('''
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = to_regclass('psyche_patientdata')
+        ORDER BY child.relname
+    ''')
+    partitions = []
+    for row in connection.execute(partitionQuery):
+        try:
+            partitions.append((row[0], datetime.strptime(row[0][len('psyche_patientdata_p'):], '%Y%m%d')))
+        except ValueError:
+            continue
+    return partitions
+
+def dropExpiredPartitions(connection, keepDays):
+    cutoff = datetime.utcnow() - timedelta(days=keepDays)
+    expiredPartitions = [name for name, start in listPartitions(connection) if partitionEnd(start) <= cutoff]
+
+    expiredRows = []
+    for name in expiredPartitions:
+        expiredRows += connection.execute(text(f'''
+            SELECT ptid, COUNT(*), SUM({sessionRowSize}), MAX(timestamp)
+            FROM {name}
+            GROUP BY ptid
+        ''')).fetchall()
+    expiredRows += connection.execute(text(f'''
+        WITH expired AS (
+            DELETE FROM psyche_patientdata_default
+            WHERE timestamp < :cutoff
+            RETURNING ptid, timestamp, {sessionRowSize} AS sizebytes
+        )
+        SELECT ptid, COUNT(*), SUM(sizebytes), MAX(timestamp)
+        FROM expired
+        GROUP BY ptid
+    '''), {'cutoff': cutoff}).fetchall()
+
+    for name in expiredPartitions:
+        connection.execute(text(f'ALTER TABLE psyche_patientdata DETACH PARTITION {name}'))
+        connection.execute(text(f'DROP TABLE {name}'))
+    expireSessionSummaries(connection, expiredRows)
+    return expiredPartitions
+
+def maintainPartitions():
+    global lastPartitionCheck
+    if lastPartitionCheck is not None and time.monotonic() - lastPartitionCheck < partitionCheckInterval:
+        return
+    lastPartitionCheck = time.monotonic()
+    try:
+        with getEngine().begin() as connection:
+            if usesPartitions(connection) and isPartitioned(connection):
+                connection.execute(text(f"SET LOCAL lock_timeout = '{partitionLockTimeout}ms'"))
+                ensurePartitions(connection)
+    except Exception as e:
+        if getattr(getattr(e, 'orig', None), 'pgcode', None) == '55P03':
+            app.logger.warning("Skipped creating psyche_patientdata partitions: table is locked")
+        else:
+            app.logger.exception("Failed to create upcoming psyche_patientdata partitions")
+
+def migratePatientDataPartitions(connection, keepLegacy=False):
+    if isPartitioned(connection):
+        return 0
+    connection.execute(text('LOCK TABLE psyche_patientdata IN ACCESS EXCLUSIVE MODE'))
+    connection.execute(text('ALTER TABLE psyche_patientdata RENAME TO psyche_patientdata_legacy'))
+    for indexName in schemaIndexes:
+        if indexName.startswith('psyche_patientdata_'):
+            connection.execute(text(f'ALTER INDEX IF EXISTS {indexName} RENAME TO psyche_patientdata_legacy_{indexName[len("psyche_patientdata_"):]}'))
+    createSchema(connection)
+
+    bounds = connection.execute(text('SELECT MIN(timestamp), MAX(timestamp) FROM psyche_patientdata_legacy')).first()
+    if bounds[0] is not None:
+        createPartitions(connection, bounds[0], bounds[1])
+    movedRows = connection.execute(text(f'''
+        INSERT INTO psyche_patientdata ({', '.join(patientDataColumns)})
+        SELECT {', '.join(patientDataColumns)} FROM psyche_patientdata_legacy
+    ''')).rowcount
+    if not keepLegacy:
+        connection.execute(text('DROP TABLE psyche_patientdata_legacy'))
+    return movedRows
+
+def createSchema(connection):
+    for tableStatement in schemaTables:
+        if usesPartitions(connection) and 'psyche_patientdata (' in tableStatement:
+            tableStatement = tableStatement.rstrip() + ' PARTITION BY RANGE (timestamp)'
+        connection.execute(text(tableStatement))
+    if usesPartitions(connection) and isPartitioned(connection):
+        ensurePartitions(connection)
+    for indexStatement in schemaIndexes.values():
+        connection.execute(text(indexStatement))
+    for indexName in retiredIndexes:
+        connection.execute(text(f'DROP INDEX IF EXISTS {indexName}'))
+
+def checkSchema(connection):
+    existingIndexes = {row[0] for row in connection.execute(text("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema()"))}
+    report = []
+    missingIndexes = [indexName for indexName in schemaIndexes if indexName not in existingIndexes]
+    report.append('Missing indexes: ' + (', '.join(missingIndexes) if missingIndexes else 'none'))
+    if isPartitioned(connection):
+        partitions = listPartitions(connection)
+        report.append(f'psyche_patientdata partitions: {len(partitions)}' + (f' ({partitions[0][0]} to {partitions[-1][0]})' if partitions else ''))
+    else:
+        report.append('psyche_patientdata partitions: not partitioned')
+
+    for queryName, (queryText, queryValues) in hotQueries.items():
+        report.append(f'\n-- {queryName}')
+        try:
+            with connection.begin_nested():
+                planRows = connection.execute(text('EXPLAIN ' + queryText), queryValues).fetchall()
+            report.extend(row[0] for row in planRows)
+        except Exception as e:
+            report.append(f'EXPLAIN failed: {e}')
+    return missingIndexes, report
+
+class EmailOutbox:
+    def __init__(self, maxAttempts, idleTimeout, background=True):
+        self.maxAttempts = maxAttempts
+        self.idleTimeout = idleTimeout
+        self.background = background
+        self.pending = queue.Queue()
+        self.retries = []
+        self.retrySequence = itertools.count()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.server = None
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    def send(self, recipient, message):
+        if not self.background:
+            return self.sendNow(recipient, message)
+        self.pending.put((recipient, message, 0))
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='email-outbox', daemon=True)
+                self.thread.start()
+        return True
+
+    def sendNow(self, recipient, message):
+        with self.lock:
+            try:
+                for attempt in range(2):
+                    try:
+                        self.connect().sendmail(getSMTPConfig()['sender'], recipient, message)
+                        self.sent += 1
+                        return True
+                    except Exception:
+                        self.disconnect()
+                        if attempt:
+                            app.logger.exception("Failed to send email to %s", recipient)
+                self.failed += 1
+                return False
+            finally:
+                self.disconnect()
+
+    def connect(self):
+        if self.server is None:
+            import smtplib
+            smtp_config = getSMTPConfig()
+            server = smtplib.SMTP(smtp_config['host'], smtp_config['port'], timeout=30)
+            if smtp_config['starttls']:
+                server.starttls()
+            if smtp_config['user']:
+                server.login(smtp_config['user'], smtp_config['password'])
+            self.server = server
+        return self.server
+
+    def disconnect(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                pass
+            self.server = None
+
+    def nextMessage(self):
+        now = time.monotonic()
+        if self.retries and self.retries[0][0] <= now:
+            return heapq.heappop(self.retries)[2:]
+        timeout = min(self.idleTimeout, self.retries[0][0] - now) if self.retries else self.idleTimeout
+        try:
+            return self.pending.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def run(self):
+        while True:
+            nextMessage = self.nextMessage()
+            if nextMessage is None:
+                if not self.retries:
+                    self.disconnect()
+                continue
+            recipient, message, attempts = nextMessage
+
+            if recipient is None:
+                self.disconnect()
+                return
+
+            try:
+                self.connect().sendmail(getSMTPConfig()['sender'], recipient, message)
+                with self.lock:
+                    self.sent += 1
+            except Exception:
+                self.disconnect()
+                attempts += 1
+                if attempts >= self.maxAttempts:
+                    app.logger.exception("Giving up on email to %s after %d attempts", recipient, attempts)
+                    with self.lock:
+                        self.failed += 1
+                    continue
+
+                with self.lock:
+                    self.retried += 1
+                notBefore = time.monotonic() + min(2 ** attempts, 60)
+                heapq.heappush(self.retries, (notBefore, next(self.retrySequence), recipient, message, attempts))
+
+    def close(self, timeout=30):
+        if self.thread is not None:
+            self.pending.put((None, None, 0))
+            self.thread.join(timeout)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending": self.pending.qsize() + len(self.retries),
+                "sent": self.sent,
+                "retried": self.retried,
+                "failed": self.failed
+            }
+
+emailOutbox = EmailOutbox(int(os.getenv('SMTP_MAX_ATTEMPTS', 5)), float(os.getenv('SMTP_IDLE_TIMEOUT', 30)), not serverless)
+atexit.register(emailOutbox.close)
+
+class ResponseCache:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entries = {}
+        self.versions = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, table, variant=None):
+        with self.lock:
+            entry = self.entries.get((table, variant))
+            if entry and entry[2] > time.monotonic():
+                self.hits += 1
+                return entry[0], entry[1], entry[3]
+            self.misses += 1
+            return None
+
+    def version(self, table):
+        with self.lock:
+            return self.versions.get(table, 0)
+
+    def put(self, table, version, payload, variant=None, headers=None):
+        body = app.json.dumps(payload)
+        etag = hashlib.sha1((body + json.dumps(headers or {}, sort_keys=True)).encode('utf-8')).hexdigest()
+        with self.lock:
+            if self.versions.get(table, 0) == version:
+                self.entries[(table, variant)] = (etag, body, time.monotonic() + self.ttl, headers or {})
+        return etag, body, headers or {}
+
+    def invalidate(self, *tables):
+        with self.lock:
+            self.invalidations += 1
+            for table in tables:
+                self.versions[table] = self.versions.get(table, 0) + 1
+            for key in [key for key in self.entries if key[0] in tables]:
+                del self.entries[key]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "ttlSeconds": self.ttl
+            }
+
+responseCache = ResponseCache(float(os.getenv('RESPONSE_CACHE_TTL', 30)))
+
+def conditionalResponse(cachedResponse):
+    etag, body, headers = cachedResponse
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers.update(headers)
+    return response
+
+maxListPageSize = 500
+
+def encodeListCursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+def decodeListCursor(cursor):
+    if not isinstance(cursor, str):
+        raise TypeError('Cursor must be a string')
+    key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if not isinstance(key, str):
+        raise ValueError('Malformed cursor')
+    return key
+
+def listPage(connection, table, keyColumn, columns, filters, filterValues, limit=None, cursor=None):
+    listValues = dict(filterValues)
+    if cursor:
+        filters = filters + [f'{keyColumn} > :afterKey']
+        listValues['afterKey'] = decodeListCursor(cursor)
+    listQuery = f"SELECT {', '.join(columns)} FROM {table}"
+    if filters:
+        listQuery += ' WHERE ' + ' AND '.join(filters)
+    listQuery += f' ORDER BY {keyColumn}'
+    if limit:
+        listQuery += ' LIMIT :limit'
+        listValues['limit'] = limit
+    rows = connection.execute(text(listQuery), listValues).fetchall()
+
+    headers = {}
+    if limit and len(rows) == limit:
+        headers['X-Next-Cursor'] = encodeListCursor(rows[-1][keyColumn])
+    return rows, headers
+
+liveFields = ['accX', 'accY', 'accZ', 'gyroX', 'gyroY', 'gyroZ', 'hr', 'presence', 'battery']
+
+class VitalsRingBuffer:
+    def __init__(self, capacity, ptid, ptname):
+        self.capacity = capacity
+        self.width = len(liveFields) + 1
+        self.values = array('d', bytes(8 * capacity * self.width))
+        self.ptid = ptid
+        self.ptname = ptname
+        self.next = 0
+        self.count = 0
+
+    def append(self, epochSeconds, fieldValues):
+        offset = self.next * self.width
+        self.values[offset] = epochSeconds
+        self.values[offset + 1:offset + self.width] = array('d', fieldValues)
+        self.next = (self.next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def recent(self, size):
+        size = min(size, self.count)
+        samples = []
+        for position in range(self.next - size, self.next):
+            offset = (position % self.capacity) * self.width
+            row = self.values[offset:offset + self.width]
+            samples.append({
+                "timestamp": datetime.utcfromtimestamp(row[0]).isoformat(),
+                **dict(zip(liveFields, row[1:]))
+            })
+        return samples
+
+class LiveVitals:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buffers = {}
+        self.lock = threading.Lock()
+
+    def record(self, devid, ptid, ptname, data):
+        try:
+            fieldValues = [float(data[field]) for field in liveFields]
+        except (KeyError, ValueError):
+            return
+        timestamp = data['timestamp']
+        epochSeconds = timestamp.replace(tzinfo=timezone.utc).timestamp()
+
+        with self.lock:
+            buffer = self.buffers.get(devid)
+            if buffer is None or buffer.ptid != ptid:
+                buffer = self.buffers[devid] = VitalsRingBuffer(self.capacity, ptid, ptname)
+            buffer.ptname = ptname
+            buffer.append(epochSeconds, fieldValues)
+
+    def snapshot(self, ptid=None, window=0):
+        with self.lock:
+            devices = []
+            for devid, buffer in sorted(self.buffers.items()):
+                if ptid and buffer.ptid != ptid:
+                    continue
+                if buffer.count == 0:
+                    continue
+
+                devices.append({
+                    "devID": devid,
+                    "ptID": buffer.ptid,
+                    "ptName": buffer.ptname,
+                    "latest": buffer.recent(1)[0],
+                    "window": buffer.recent(window) if window else []
+                })
+            return devices
+
+    def forget(self, devids):
+        with self.lock:
+            for devid in devids:
+                self.buffers.pop(devid, None)
+
+liveVitals = LiveVitals(int(os.getenv('LIVE_BUFFER_CAPACITY', 600)))
+
+class LiveSubscriber:
+    def __init__(self, ptid, devid, queueSize):
+        self.ptid = ptid
+        self.devid = devid
+        self.events = deque(maxlen=queueSize)
+        self.ready = threading.Event()
+        self.dropped = 0
+
+    def matches(self, devid, ptid):
+        return (not self.ptid or self.ptid == ptid) and (not self.devid or self.devid == devid)
+
+class LiveBroker:
+    def __init__(self, maxSubscribers, queueSize, keepaliveSeconds, maxStreamSeconds):
+        self.maxSubscribers = maxSubscribers
+        self.queueSize = queueSize
+        self.keepaliveSeconds = keepaliveSeconds
+        self.maxStreamSeconds = maxStreamSeconds
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, ptid=None, devid=None):
+        with self.lock:
+            if len(self.subscribers) >= self.maxSubscribers:
+                return None
+            subscriber = LiveSubscriber(ptid, devid, self.queueSize)
+            self.subscribers.add(subscriber)
+            return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+            self.dropped += subscriber.dropped
+
+    def publish(self, devid, ptid, ptname, data):
+        with self.lock:
+            subscribers = [subscriber for subscriber in self.subscribers if subscriber.matches(devid, ptid)]
+            self.published += 1
+        if not subscribers:
+            return
+
+        try:
+            fieldValues = {field: float(data[field]) for field in liveFields}
+        except (KeyError, ValueError):
+            return
+        event = 'data: ' + json.dumps({
+            "devID": devid,
+            "ptID": ptid,
+            "ptName": ptname,
+            "timestamp": formatTimestamp(data['timestamp']),
+            **fieldValues
+        }) + '\n\n'
+        for subscriber in subscribers:
+            if len(subscriber.events) == subscriber.events.maxlen:
+                subscriber.dropped += 1
+            subscriber.events.append(event)
+            subscriber.ready.set()
+
+    def stream(self, subscriber):
+        deadline = time.monotonic() + self.maxStreamSeconds if self.maxStreamSeconds else None
+        reportedDrops = 0
+        try:
+            yield 'retry: 3000\n\n'
+            while deadline is None or time.monotonic() < deadline:
+                subscriber.ready.wait(self.keepaliveSeconds)
+                subscriber.ready.clear()
+
+                events = []
+                while subscriber.events:
+                    events.append(subscriber.events.popleft())
+                if subscriber.dropped > reportedDrops:
+                    events.insert(0, f'event: dropped\ndata: {subscriber.dropped - reportedDrops}\n\n')
+                    reportedDrops = subscriber.dropped
+                yield ''.join(events) if events else ': keepalive\n\n'
+        finally:
+            self.unsubscribe(subscriber)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "subscribers": len(self.subscribers),
+                "published": self.published,
+                "dropped": self.dropped + sum(subscriber.dropped for subscriber in self.subscribers)
+            }
+
+liveBroker = LiveBroker(
+    int(os.getenv('SSE_MAX_SUBSCRIBERS', 500)),
+    int(os.getenv('SSE_QUEUE_SIZE', 256)),
+    float(os.getenv('SSE_KEEPALIVE', 15)),
+    float(os.getenv('SSE_MAX_SECONDS', 300))
+)
+
+class RollupAccumulator:
+    def __init__(self, flushInterval, closeDelay, background=True):
+        self.flushInterval = flushInterval
+        self.closeDelay = closeDelay
+        self.background = background
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.flushedBuckets = 0
+        self.failedFlushes = 0
+
+    def add(self, ptid, data):
+        try:
+            present = int(float(data['presence'])) != 0
+            hr = float(data['hr'])
+            accX, accY, accZ = float(data['accX']), float(data['accY']), float(data['accZ'])
+            gyroX, gyroY, gyroZ = float(data['gyroX']), float(data['gyroY']), float(data['gyroZ'])
+        except (KeyError, ValueError):
+            return
+        if not isinstance(data.get('timestamp'), datetime) or data['timestamp'].tzinfo is not None:
+            return
+        bucket = data['timestamp'].replace(second=0, microsecond=0)
+
+        with self.lock:
+            rollup = self.buckets.get((ptid, bucket))
+            if rollup is None:
+                rollup = self.buckets[(ptid, bucket)] = {
+                    'ptid': ptid, 'bucket': bucket, 'samples': 0, 'presentsamples': 0, 'hrsum': 0.0,
+                    'hrcount': 0, 'hrmax': None, 'activitysum': 0.0, 'gyroenergysum': 0.0
+                }
+            rollup['samples'] += 1
+            if present:
+                rollup['presentsamples'] += 1
+                rollup['hrsum'] += hr
+                rollup['hrcount'] += 1
+                rollup['hrmax'] = hr if rollup['hrmax'] is None else max(rollup['hrmax'], hr)
+                rollup['activitysum'] += (accX * accX + accY * accY + accZ * accZ) ** 0.5
+                rollup['gyroenergysum'] += gyroX * gyroX + gyroY * gyroY + gyroZ * gyroZ
+
+            if self.background and self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='rollup-flusher', daemon=True)
+                self.thread.start()
+
+    def flush(self, closedOnly=True):
+        cutoff = datetime.utcnow() - timedelta(seconds=60 + self.closeDelay)
+        with self.lock:
+            closedKeys = sorted(key for key in self.buckets if not closedOnly or key[1] <= cutoff)
+            closedRollups = [self.buckets.pop(key) for key in closedKeys]
+        if not closedRollups:
+            return
+
+        rollupUpsertQuery = text('''
+            INSERT INTO psyche_patientrollup
+            (ptid, bucket, samples, presentsamples, hrsum, hrcount, hrmax, activitysum, gyroenergysum)
+            VALUES (:ptid, :bucket, :samples, :presentsamples, :hrsum, :hrcount, :hrmax, :activitysum, :gyroenergysum)
+            ON CONFLICT (ptid, bucket) DO UPDATE SET
+                samples = psyche_patientrollup.samples + excluded.samples,
+                presentsamples = psyche_patientrollup.presentsamples + excluded.presentsamples,
+                hrsum = psyche_patientrollup.hrsum + excluded.hrsum,
+                hrcount = psyche_patientrollup.hrcount + excluded.hrcount,
+                hrmax = CASE WHEN psyche_patientrollup.hrmax IS NULL OR excluded.hrmax > psyche_patientrollup.hrmax
+                    THEN excluded.hrmax ELSE psyche_patientrollup.hrmax END,
+                activitysum = psyche_patientrollup.activitysum + excluded.activitysum,
+                gyroenergysum = psyche_patientrollup.gyroenergysum + excluded.gyroenergysum
+        ''')
+        try:
+            with getEngine().begin() as connection:
+                connection.execute(rollupUpsertQuery, closedRollups)
+        except Exception:
+            with self.lock:
+                self.failedFlushes += 1
+                for rollup in closedRollups:
+                    self.merge(rollup)
+            raise
+        with self.lock:
+            self.flushedBuckets += len(closedRollups)
+
+    def flushedBefore(self):
+        return (datetime.utcnow() - timedelta(seconds=60 + self.closeDelay + self.flushInterval + 60)).replace(second=0, microsecond=0)
+
+    def merge(self, rollup):
+        key = (rollup['ptid'], rollup['bucket'])
+        current = self.buckets.get(key)
+        if current is None:
+            self.buckets[key] = rollup
+            return
+        for field in ('samples', 'presentsamples', 'hrsum', 'hrcount', 'activitysum', 'gyroenergysum'):
+            current[field] += rollup[field]
+        if rollup['hrmax'] is not None:
+            current['hrmax'] = rollup['hrmax'] if current['hrmax'] is None else max(current['hrmax'], rollup['hrmax'])
+
+    def run(self):
+        while True:
+            time.sleep(self.flushInterval)
+            try:
+                self.flush()
+            except Exception:
+                app.logger.exception("Failed to flush patient rollups")
+
+    def close(self):
+        try:
+            self.flush(closedOnly=False)
+        except Exception:
+            app.logger.exception("Failed to flush patient rollups on shutdown")
+
+    def flushRequest(self):
+        if self.background:
+            return
+        try:
+            self.flush(closedOnly=False)
+        except Exception:
+            app.logger.exception("Failed to flush patient rollups")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "openBuckets": len(self.buckets),
+                "flushedBuckets": self.flushedBuckets,
+                "failedFlushes": self.failedFlushes
+            }
+
+patientRollups = RollupAccumulator(float(os.getenv('ROLLUP_FLUSH_INTERVAL', 30)), float(os.getenv('ROLLUP_CLOSE_DELAY', 30)), not serverless)
+atexit.register(patientRollups.close)
+
+def backfillRollups(connection, since=None, until=None):
+    backfillQuery = text('''
+        INSERT INTO psyche_patientrollup
+        (ptid, bucket, samples, presentsamples, hrsum, hrcount, hrmax, activitysum, gyroenergysum)
+        SELECT ptid,
+               date_trunc('minute', timestamp),
+               COUNT(*),
+               COUNT(*) FILTER (WHERE presence <> 0),
+               COALESCE(SUM(hr) FILTER (WHERE presence <> 0), 0),
+               COUNT(hr) FILTER (WHERE presence <> 0),
+               MAX(hr) FILTER (WHERE presence <> 0),
+               COALESCE(SUM(sqrt(accx * accx + accy * accy + accz * accz)) FILTER (WHERE presence <> 0), 0),
+               COALESCE(SUM(gyrox * gyrox + gyroy * gyroy + gyroz * gyroz) FILTER (WHERE presence <> 0), 0)
+        FROM psyche_patientdata
+        WHERE timestamp >= :since AND timestamp < :until
+        GROUP BY 1, 2
+        ON CONFLICT (ptid, bucket) DO NOTHING
+    ''')
+    flushedBefore = patientRollups.flushedBefore()
+    backfillValues = {'since': since or datetime(1970, 1, 1), 'until': min(until or flushedBefore, flushedBefore)}
+    return connection.execute(backfillQuery, backfillValues).rowcount
+
+featureChunkRows = int(os.getenv('FEATURE_CHUNK_ROWS', 50000))
+featureWorkers = int(os.getenv('FEATURE_WORKERS', 1))
+featureEpochSeconds = 60
+featureRestlessThreshold = float(os.getenv('FEATURE_RESTLESS_THRESHOLD', 0.5))
+featureGapSeconds = float(os.getenv('FEATURE_GAP_SECONDS', 10))
+maxFeaturePatients = 200
+maxReportedGaps = 100
+featureColumns = ['timestamp', 'accx', 'accy', 'accz', 'gyrox', 'gyroy', 'gyroz', 'hr', 'presence']
+
+def loadPatientArrays(connection, ptID, startTimestamp, endTimestamp, chunkRows=featureChunkRows):
+    import numpy as np
+
+    patientDataQuery = text(f'''
+        SELECT {', '.join(featureColumns)} FROM psyche_patientdata
+        WHERE ptid = :ptid AND timestamp >= :start AND timestamp < :end
+        ORDER BY timestamp
+    ''')
+    result = connection.execution_options(stream_results=True).execute(
+        patientDataQuery, {'ptid': ptID, 'start': startTimestamp, 'end': endTimestamp}
+    )
+    columnChunks = {column: [] for column in featureColumns}
+    while True:
+        rows = result.fetchmany(chunkRows)
+        if not rows:
+            break
+        columns = list(zip(*rows))
+        timestamps = np.array(columns[0], dtype='datetime64[us]')
+        columnChunks['timestamp'].append((timestamps - np.datetime64(0, 'us')) / np.timedelta64(1, 's'))
+        for column, values in zip(featureColumns[1:], columns[1:]):
+            columnChunks[column].append(np.array(values, dtype='float64'))
+
+    return {
+        column: np.concatenate(chunks) if chunks else np.empty(0, dtype='float64')
+        for column, chunks in columnChunks.items()
+    }
+
+def extractFeatures(arrays, epochSeconds=featureEpochSeconds, restlessThreshold=featureRestlessThreshold, gapSeconds=featureGapSeconds):
+    import numpy as np
+
+    seconds = arrays['timestamp']
+    if not len(seconds):
+        return {"samples": 0}
+    present = arrays['presence'] != 0
+
+    magnitude = np.sqrt(arrays['accx'] ** 2 + arrays['accy'] ** 2 + arrays['accz'] ** 2)
+    movement = np.abs(magnitude - np.median(magnitude[present])) if present.any() else np.zeros_like(magnitude)
+    gyroEnergy = arrays['gyrox'] ** 2 + arrays['gyroy'] ** 2 + arrays['gyroz'] ** 2
+    epochIndex = np.unique(np.floor(seconds / epochSeconds), return_inverse=True)[1]
+    epochPresent = np.bincount(epochIndex, weights=present)
+    epochMovement = np.bincount(epochIndex, weights=movement * present)[epochPresent > 0] / epochPresent[epochPresent > 0]
+    restless = epochMovement > restlessThreshold
+    stillRuns = np.diff(np.flatnonzero(np.concatenate(([True], restless, [True])))) - 1
+
+    heartRates = arrays['hr'][present & (arrays['hr'] > 0)]
+    intervals = 60000.0 / heartRates
+    successiveDifferences = np.diff(intervals)
+
+    gaps = np.diff(seconds)
+    gapIndexes = np.flatnonzero(gaps > gapSeconds)
+    span = float(seconds[-1] - seconds[0])
+
+    return {
+        "samples": int(len(seconds)),
+        "start": datetime.utcfromtimestamp(seconds[0]).isoformat(),
+        "end": datetime.utcfromtimestamp(seconds[-1]).isoformat(),
+        "activity": {
+            "magnitudeMean": float(magnitude[present].mean()) if present.any() else None,
+            "movementMean": float(movement[present].mean()) if present.any() else None,
+            "gyroEnergyMean": float(gyroEnergy[present].mean()) if present.any() else None,
+            "epochs": int(len(epochMovement)),
+            "restlessEpochs": int(restless.sum()),
+            "restlessFraction": float(restless.mean()) if len(restless) else None,
+            "longestStillEpochs": int(stillRuns.max()) if len(stillRuns) else 0
+        },
+        "heartRate": {
+            "samples": int(len(heartRates)),
+            "mean": float(heartRates.mean()) if len(heartRates) else None,
+            "std": float(heartRates.std()) if len(heartRates) else None,
+            "min": float(heartRates.min()) if len(heartRates) else None,
+            "max": float(heartRates.max()) if len(heartRates) else None,
+            "p5": float(np.percentile(heartRates, 5)) if len(heartRates) else None,
+            "p95": float(np.percentile(heartRates, 95)) if len(heartRates) else None,
+            "intervalSDNN": float(intervals.std()) if len(intervals) else None,
+            "intervalRMSSD": float(np.sqrt(np.mean(successiveDifferences ** 2))) if len(successiveDifferences) else None
+        },
+        "presence": {
+            "fraction": float(present.mean()),
+            "gapCount": int(len(gapIndexes)),
+            "gapSeconds": float(gaps[gapIndexes].sum()),
+            "coverage": 1.0 - float(gaps[gapIndexes].sum()) / span if span else 1.0,
+            "gaps": [
+                {
+                    "start": datetime.utcfromtimestamp(seconds[gapIndex]).isoformat(),
+                    "end": datetime.utcfromtimestamp(seconds[gapIndex + 1]).isoformat(),
+                    "seconds": float(gaps[gapIndex])
+                } for gapIndex in gapIndexes[:maxReportedGaps]
+            ]
+        }
+    }
+
+def patientFeatures(ptID, startTimestamp, endTimestamp, epochSeconds=featureEpochSeconds):
+    with getEngine().connect() as connection:
+        arrays = loadPatientArrays(connection, ptID, startTimestamp, endTimestamp)
+    return dict(extractFeatures(arrays, epochSeconds), ptID=ptID)
+
+def computePatientFeatures(ptIDs, startTimestamp, endTimestamp, epochSeconds=featureEpochSeconds, workers=1):
+    if workers <= 1 or len(ptIDs) <= 1:
+        return [patientFeatures(ptID, startTimestamp, endTimestamp, epochSeconds) for ptID in ptIDs]
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(min(workers, len(ptIDs)), mp_context=multiprocessing.get_context('spawn')) as executor:
+        return list(executor.map(
+            patientFeatures, ptIDs, [startTimestamp] * len(ptIDs), [endTimestamp] * len(ptIDs), [epochSeconds] * len(ptIDs)
+        ))
+
+archiveDirectory = os.getenv('ARCHIVE_DIR')
+archiveChunkRows = int(os.getenv('ARCHIVE_CHUNK_ROWS', 100000))
+
+def archivePath(ptID, *parts):
+    if not ptID or os.path.basename(ptID) != ptID or ptID in ('.', '..'):
+        raise ValueError(f'Invalid patient ID for archive: {ptID!r}')
+    return os.path.join(archiveDirectory, ptID, *parts)
+
+def writeArchiveFile(path, encodedChunks):
+    temporaryPath = path + '.tmp'
+    with open(temporaryPath, 'wb') as archiveFile:
+        for chunk in encodedChunks:
+            archiveFile.write(chunk)
+    os.replace(temporaryPath, path)
+
+def archivePatientData(ptID):
+    export = PatientExport(ptID, archiveChunkRows, ordered=True)
+    try:
+        if not export.firstRows:
+            return None
+
+        archivedAt = datetime.utcnow()
+        archiveName = archivedAt.strftime('%Y%m%dT%H%M%S%f')
+        os.makedirs(archivePath(ptID, archiveName))
+        timestampIndex = export.columns.index('timestamp')
+        manifest = {
+            "ptID": ptID,
+            "ptName": export.firstRows[0][export.columns.index('ptname')],
+            "archivedAt": archivedAt.isoformat(),
+            "format": "csv.gz",
+            "columns": export.columns,
+            "rows": 0,
+            "chunks": []
+        }
+        for chunkIndex, rows in enumerate(export.chunks()):
+            fileName = f'chunk-{chunkIndex:05d}.csv.gz'
+            writeArchiveFile(archivePath(ptID, archiveName, fileName), gzipChunks(csvChunks(export.columns, [rows])))
+            manifest['chunks'].append({
+                "file": fileName,
+                "rows": len(rows),
+                "bytes": os.path.getsize(archivePath(ptID, archiveName, fileName)),
+                "firstTimestamp": str(formatTimestamp(rows[0][timestampIndex])),
+                "lastTimestamp": str(formatTimestamp(rows[-1][timestampIndex]))
+            })
+            manifest['rows'] += len(rows)
+        writeArchiveFile(archivePath(ptID, archiveName, 'manifest.json'), [json.dumps(manifest, indent=2).encode('utf-8')])
+
+        export.complete()
+        return manifest
+    finally:
+        export.close()
+
+def decodeArchiveCursor(cursor):
+    if not isinstance(cursor, str):
+        raise TypeError('Cursor must be a string')
+    afterArchive, afterChunk, afterRow = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    if not isinstance(afterArchive, str) or any(type(value) is not int or value < 0 for value in (afterChunk, afterRow)):
+        raise ValueError('Malformed cursor')
+    return afterArchive, afterChunk, afterRow
+
+def archivedPatientData(ptID, startTimestamp, endTimestamp, limit, cursor=None):
+    afterArchive, afterChunk, afterRow = decodeArchiveCursor(cursor) if cursor else ('', 0, 0)
+    if not os.path.isdir(archivePath(ptID)):
+        return [], None
+
+    points = []
+    for archiveName in sorted(os.listdir(archivePath(ptID))):
+        manifestPath = archivePath(ptID, archiveName, 'manifest.json')
+        if archiveName < afterArchive or not os.path.exists(manifestPath):
+            continue
+        with open(manifestPath) as manifestFile:
+            manifest = json.load(manifestFile)
+
+        for chunkIndex, chunk in enumerate(manifest['chunks']):
+            if (archiveName, chunkIndex) < (afterArchive, afterChunk):
+                continue
+            if datetime.fromisoformat(chunk['lastTimestamp']) < startTimestamp or datetime.fromisoformat(chunk['firstTimestamp']) >= endTimestamp:
+                continue
+            skipRows = afterRow if (archiveName, chunkIndex) == (afterArchive, afterChunk) else 0
+
+            with gzip.open(archivePath(ptID, archiveName, chunk['file']), 'rt', newline='') as chunkFile:
+                for rowIndex, row in enumerate(csv.DictReader(chunkFile)):
+                    if rowIndex < skipRows:
+                        continue
+                    timestamp = datetime.fromisoformat(row['timestamp'])
+                    if timestamp >= endTimestamp:
+                        break
+                    if timestamp < startTimestamp:
+                        continue
+                    if len(points) == limit:
+                        return points, base64.urlsafe_b64encode(json.dumps([archiveName, chunkIndex, rowIndex]).encode()).decode()
+                    points.append({
+                        "timestamp": timestamp.isoformat(),
+                        "devID": row['devid'],
+                        **{column: toFloat(row[column] or None) for column in bucketColumns},
+                        "presence": toFloat(row['presence'] or None),
+                        "battery": toFloat(row['battery'] or None)
+                    })
+    return points, None
+
+class TimedQueuePool(QueuePool):
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except Exception:
+            metrics.recordPoolTimeout()
+            raise
+        finally:
+            metrics.recordPoolWait(time.perf_counter() - start)
+
+def metricLabels(**labels):
+    escapedLabels = {name: str(value).replace('\\', '\\\\').replace('"', '\\"') for name, value in labels.items()}
+    return ','.join(f'{name}="{value}"' for name, value in escapedLabels.items())
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.total += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = [f'{name}_bucket{{{labels},le="{bound}"}} {count}' for bound, count in zip(self.buckets, self.counts)]
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {self.total}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+class Metrics:
+    latencyBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    queryCountBuckets = (0, 1, 2, 5, 10, 20, 50, 100)
+    poolWaitBuckets = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+
+    def __init__(self, slowQuerySeconds):
+        self.slowQuerySeconds = slowQuerySeconds
+        self.lock = threading.Lock()
+        self.routes = {}
+        self.statuses = {}
+        self.queries = {}
+        self.slowQueries = 0
+        self.poolWaits = Histogram(self.poolWaitBuckets)
+        self.poolTimeouts = 0
+
+    def routeLabel(self):
+        if not has_request_context():
+            return 'background'
+        return request.url_rule.rule if request.url_rule else 'unmatched'
+
+    def beforeQuery(self, connection, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._psycheQueryStart = time.perf_counter()
+
+    def afterQuery(self, connection, cursor, statement, parameters, context, executemany):
+        if getattr(context, '_psycheQueryStart', None) is None:
+            return
+        elapsed = time.perf_counter() - context._psycheQueryStart
+        route = self.routeLabel()
+        if has_request_context() and 'queryCount' in g:
+            g.queryCount += 1
+            g.querySeconds += elapsed
+        with self.lock:
+            queryCounts = self.queries.setdefault(route, [0, 0.0])
+            queryCounts[0] += 1
+            queryCounts[1] += elapsed
+            if self.slowQuerySeconds and elapsed >= self.slowQuerySeconds:
+                self.slowQueries += 1
+        if self.slowQuerySeconds and elapsed >= self.slowQuerySeconds:
+            app.logger.warning("Slow query on %s took %.3fs: %s", route, elapsed, ' '.join(statement.split())[:1000])
+
+    def recordPoolWait(self, seconds):
+        with self.lock:
+            self.poolWaits.observe(seconds)
+
+    def recordPoolTimeout(self):
+        with self.lock:
+            self.poolTimeouts += 1
+
+    def recordRequest(self, method, route, requestBytes, requestGlobals, response):
+        elapsed = time.perf_counter() - requestGlobals.metricsStart
+        key = (method, route)
+        with self.lock:
+            routeMetrics = self.routes.get(key)
+            if routeMetrics is None:
+                routeMetrics = self.routes[key] = {
+                    'latency': Histogram(self.latencyBuckets),
+                    'queries': Histogram(self.queryCountBuckets),
+                    'querySeconds': 0.0,
+                    'requestBytes': 0,
+                    'responseBytes': 0
+                }
+            routeMetrics['latency'].observe(elapsed)
+            routeMetrics['queries'].observe(requestGlobals.queryCount)
+            routeMetrics['querySeconds'] += requestGlobals.querySeconds
+            routeMetrics['requestBytes'] += requestBytes
+            routeMetrics['responseBytes'] += response.content_length or 0
+            self.statuses[key + (response.status_code,)] = self.statuses.get(key + (response.status_code,), 0) + 1
+
+    def render(self):
+        lines = []
+        with self.lock:
+            lines.append('# TYPE psyche_request_duration_seconds histogram')
+            for (method, route), routeMetrics in sorted(self.routes.items()):
+                lines.extend(routeMetrics['latency'].render('psyche_request_duration_seconds', metricLabels(method=method, route=route)))
+            lines.append('# TYPE psyche_requests_total counter')
+            for (method, route, status), count in sorted(self.statuses.items()):
+                lines.append(f'psyche_requests_total{{{metricLabels(method=method, route=route, status=status)}}} {count}')
+            lines.append('# TYPE psyche_request_queries histogram')
+            for (method, route), routeMetrics in sorted(self.routes.items()):
+                lines.extend(routeMetrics['queries'].render('psyche_request_queries', metricLabels(method=method, route=route)))
+            for name, field in (
+                ('psyche_request_query_seconds_total', 'querySeconds'),
+                ('psyche_request_bytes_total', 'requestBytes'),
+                ('psyche_response_bytes_total', 'responseBytes')
+            ):
+                lines.append(f'# TYPE {name} counter')
+                for (method, route), routeMetrics in sorted(self.routes.items()):
+                    lines.append(f'{name}{{{metricLabels(method=method, route=route)}}} {routeMetrics[field]}')
+            lines.append('# TYPE psyche_sql_queries_total counter')
+            for route, (count, seconds) in sorted(self.queries.items()):
+                lines.append(f'psyche_sql_queries_total{{{metricLabels(route=route)}}} {count}')
+            lines.append('# TYPE psyche_sql_query_seconds_total counter')
+            for route, (count, seconds) in sorted(self.queries.items()):
+                lines.append(f'psyche_sql_query_seconds_total{{{metricLabels(route=route)}}} {seconds}')
+            lines.append('# TYPE psyche_sql_slow_queries_total counter')
+            lines.append(f'psyche_sql_slow_queries_total {self.slowQueries}')
+            lines.append('# TYPE psyche_pool_checkout_wait_seconds histogram')
+            lines.extend(self.poolWaits.render('psyche_pool_checkout_wait_seconds', metricLabels(pool='primary')))
+            lines.append('# TYPE psyche_pool_checkout_failures_total counter')
+            lines.append(f'psyche_pool_checkout_failures_total {self.poolTimeouts}')
+        if engine is not None and isinstance(engine.pool, QueuePool):
+            for name, value in (
+                ('psyche_pool_size', engine.pool.size()),
+                ('psyche_pool_checked_out', engine.pool.checkedout()),
+                ('psyche_pool_overflow', engine.pool.overflow()),
+                ('psyche_pool_idle', engine.pool.checkedin())
+            ):
+                lines.append(f'# TYPE {name} gauge')
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics(float(os.getenv('SLOW_QUERY_SECONDS', 0)))
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='PSYCHE API maintenance commands.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('refresh-sessions', help='Rebuild psyche_sessionsummary from psyche_patientdata.')
+    schemaCommand = commands.add_parser('schema', help='Create missing tables and indexes.')
+    schemaCommand.add_argument('--check', action='store_true', help='Report missing indexes and EXPLAIN hot queries instead.')
+    backfillCommand = commands.add_parser('rollup-backfill', help='Rebuild psyche_patientrollup minutes from psyche_patientdata.')
+    backfillCommand.add_argument('--since', type=parseDeviceTimestamp, default=None)
+    backfillCommand.add_argument('--until', type=parseDeviceTimestamp, default=None)
+    partitionsCommand = commands.add_parser('partitions', help='Create upcoming psyche_patientdata partitions and drop expired ones.')
+    partitionsCommand.add_argument('--retention-days', type=int, default=retentionDays)
+    migrateCommand = commands.add_parser('partition-migrate', help='Move an unpartitioned psyche_patientdata into a partitioned table.')
+    migrateCommand.add_argument('--keep-legacy', action='store_true', help='Keep the old table as psyche_patientdata_legacy.')
+    featuresCommand = commands.add_parser('features', help='Print activity and heart-rate features per patient as JSON lines.')
+    featuresCommand.add_argument('--since', type=parseDeviceTimestamp, required=True)
+    featuresCommand.add_argument('--until', type=parseDeviceTimestamp, default=None)
+    featuresCommand.add_argument('--ptid', nargs='+', default=None)
+    featuresCommand.add_argument('--epoch', type=float, default=featureEpochSeconds)
+    featuresCommand.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    if args.command == 'refresh-sessions':
+        with getEngine().begin() as connection:
+            refreshSessionSummaries(connection)
+    elif args.command == 'schema':
+        with getEngine().begin() as connection:
+            if args.check:
+                missingIndexes, report = checkSchema(connection)
+                print('\n'.join(report))
+                raise SystemExit(1 if missingIndexes else 0)
+            createSchema(connection)
+    elif args.command == 'rollup-backfill':
+        with getEngine().begin() as connection:
+            print(f'Backfilled {backfillRollups(connection, args.since, args.until)} rollup minutes.')
+    elif args.command == 'partitions':
+        with getEngine().begin() as connection:
+            if not isPartitioned(connection):
+                raise SystemExit('psyche_patientdata is not partitioned; run partition-migrate first.')
+            print(f'Created {len(ensurePartitions(connection))} upcoming partitions.')
+            earliestTimestamp = datetime.utcnow() - timedelta(days=args.retention_days) if args.retention_days else datetime(1970, 1, 1)
+            print(f'Created {len(splitDefaultPartition(connection, earliestTimestamp))} partitions for rows in psyche_patientdata_default.')
+            if args.retention_days:
+                droppedPartitions = dropExpiredPartitions(connection, args.retention_days)
+                print(f"Dropped {len(droppedPartitions)} expired partitions: {', '.join(droppedPartitions) or 'none'}")
+    elif args.command == 'partition-migrate':
+        with getEngine().begin() as connection:
+            if not usesPartitions(connection):
+                raise SystemExit('Set PATIENTDATA_PARTITION to day or week on a PostgreSQL database to partition psyche_patientdata.')
+            print(f'Moved {migratePatientDataPartitions(connection, args.keep_legacy)} rows into partitioned psyche_patientdata.')
+    elif args.command == 'features':
+        ptIDs = args.ptid
+        if not ptIDs:
+            with getEngine().connect() as connection:
+                sessionQuery = text('SELECT ptid FROM psyche_sessionsummary WHERE rowcount > 0 ORDER BY ptid')
+                ptIDs = [row['ptid'] for row in connection.execute(sessionQuery)]
+        for features in computePatientFeatures(ptIDs, args.since, args.until or datetime.utcnow(), args.epoch, args.workers):
+            print(json.dumps(features))
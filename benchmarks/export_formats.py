@@ -0,0 +1,73 @@
+"""Compare export size and encode/decode time for the CSV and NPZ formats.
+
+    python benchmarks/export_formats.py --rows 100000 1000000
+
+Rows are synthetic and fed straight into the export encoders, so no database
+is needed. CSV decoding uses pandas, which is not an API dependency and has to
+be installed separately.
+"""
+import argparse
+import io
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000])
+parser.add_argument('--chunk-rows', type=int, default=5000)
+args = parser.parse_args()
+
+os.environ.setdefault('POSTGRES_URL', 'sqlite://')
+os.environ.setdefault('SMTP_PORT', '25')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+import numpy as np
+import pandas as pd
+import index
+
+def syntheticChunks(rowCount):
+    start = datetime(2024, 1, 1)
+    for chunkStart in range(0, rowCount, args.chunk_rows):
+        yield [
+            (
+                'P001', 'Bench Patient', start + timedelta(milliseconds=offset * 50), '7',
+                round(random.gauss(0, 1), 6), round(random.gauss(0, 1), 6), round(random.gauss(9.8, 1), 6),
+                round(random.gauss(0, 0.5), 6), round(random.gauss(0, 0.5), 6), round(random.gauss(0, 0.5), 6),
+                random.randint(55, 110), 1, 100 - offset // 100000
+            )
+            for offset in range(chunkStart, min(chunkStart + args.chunk_rows, rowCount))
+        ]
+
+def encode(encoder, rowCount):
+    chunks = list(syntheticChunks(rowCount))
+    start = time.perf_counter()
+    payload = b''.join(encoder(index.patientDataColumns, iter(chunks)))
+    return payload, time.perf_counter() - start
+
+def decodeCSV(payload):
+    return pd.read_csv(io.BytesIO(payload), parse_dates=['timestamp'])
+
+def decodeNPZ(payload):
+    with np.load(io.BytesIO(payload)) as archive:
+        return {name: archive[name] for name in archive.files}
+
+def main():
+    print(f"{'rows':>10} {'format':>7} {'MB':>9} {'encode s':>9} {'decode s':>9}")
+    for rowCount in args.rows:
+        for formatName, encoder, decoder in (
+            ('csv', index.csvChunks, decodeCSV),
+            ('csv.gz', lambda columns, chunks: index.gzipChunks(index.csvChunks(columns, chunks)), None),
+            ('npz', index.npzChunks, decodeNPZ),
+        ):
+            payload, encodeSeconds = encode(encoder, rowCount)
+            decodeSeconds = float('nan')
+            if decoder:
+                start = time.perf_counter()
+                decoder(payload)
+                decodeSeconds = time.perf_counter() - start
+            print(f"{rowCount:>10} {formatName:>7} {len(payload) / 1e6:>9.2f} {encodeSeconds:>9.3f} {decodeSeconds:>9.3f}")
+
+if __name__ == '__main__':
+    main()
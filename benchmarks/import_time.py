@@ -0,0 +1,61 @@
+"""Report how long `import index` takes, as a proxy for serverless cold starts.
+
+    python benchmarks/import_time.py --runs 5 --top 15 --max-ms 400
+
+Each run imports api/index.py in a fresh interpreter under `-X importtime`.
+The slowest top-level imports from the median run are listed. With --max-ms
+the script exits non-zero when the median total exceeds the budget.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--runs', type=int, default=5)
+parser.add_argument('--top', type=int, default=15)
+parser.add_argument('--max-ms', type=float, default=None)
+args = parser.parse_args()
+
+apiDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api')
+
+def importTimes():
+    environment = dict(os.environ, POSTGRES_URL=os.getenv('POSTGRES_URL', 'sqlite://'))
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import index'],
+        cwd=apiDirectory, env=environment, capture_output=True, text=True, check=True
+    )
+    modules = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append((name.strip(), int(cumulative) / 1000, depth))
+    return modules
+
+def main():
+    runs = []
+    for _ in range(args.runs):
+        modules = importTimes()
+        total = next(cumulative for name, cumulative, depth in modules if name == 'index')
+        runs.append((total, modules))
+    runs.sort(key=lambda run: run[0])
+    medianTotal, medianModules = runs[len(runs) // 2]
+
+    print(f"import index: median {medianTotal:.1f} ms over {args.runs} runs "
+          f"(min {runs[0][0]:.1f} ms, max {runs[-1][0]:.1f} ms, stdev {statistics.pstdev(run[0] for run in runs):.1f} ms)")
+    topLevel = sorted(
+        ((name, cumulative) for name, cumulative, depth in medianModules if depth == 1),
+        key=lambda module: module[1], reverse=True
+    )
+    for name, cumulative in topLevel[:args.top]:
+        print(f"{cumulative:>10.1f} ms  {name}")
+
+    if args.max_ms is not None and medianTotal > args.max_ms:
+        print(f"import time {medianTotal:.1f} ms exceeds budget of {args.max_ms:.1f} ms")
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
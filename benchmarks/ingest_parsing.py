@@ -0,0 +1,71 @@
+"""Compare per-sample parse cost of text and binary ingest payloads.
+
+    python benchmarks/ingest_parsing.py --samples 1000 10000 100000
+
+This times only decoding, from request body bytes to sample dicts ready for
+insertion, without Flask or the database. The text path is the
+comma-separated /stored-data-batch format. The binary path is the
+application/x-psyche-frames struct layout.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--samples', type=int, nargs='+', default=[1000, 10000, 100000])
+parser.add_argument('--repeat', type=int, default=5)
+args = parser.parse_args()
+
+os.environ.setdefault('POSTGRES_URL', 'sqlite://')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+import numpy as np
+import index
+
+frameDtype = np.dtype(index.binaryFrameFields)
+
+def syntheticSamples(count):
+    return [
+        (1700000000 + sample * 0.05, sample % 40 + 1,
+         random.gauss(0, 1), random.gauss(0, 1), random.gauss(9.8, 1),
+         random.gauss(0, 0.5), random.gauss(0, 0.5), random.gauss(0, 0.5),
+         random.randint(55, 110), 1, 87.5)
+        for sample in range(count)
+    ]
+
+def textBody(samples):
+    return '\n'.join(
+        f'{timestamp:.3f},{devID},' + ','.join(f'{value:.4f}' for value in sensorValues) + f',{hr},{presence},{battery}'
+        for timestamp, devID, *sensorValues, hr, presence, battery in samples
+    ).encode()
+
+def binaryBody(samples):
+    return np.array(samples, dtype=frameDtype).tobytes()
+
+def parseText(body):
+    return [index.parseBatchSample(line.split(',')) for line in body.decode().splitlines() if line.strip()]
+
+def bestOf(parser, body):
+    timings = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        parser(body)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def main():
+    index.decodeFrames(binaryBody(syntheticSamples(1)))
+    print(f"{'samples':>10} {'format':>7} {'KB':>10} {'us/sample':>10}")
+    for count in args.samples:
+        samples = syntheticSamples(count)
+        for formatName, body, parser in (
+            ('text', textBody(samples), parseText),
+            ('binary', binaryBody(samples), index.decodeFrames),
+        ):
+            seconds = bestOf(parser, body)
+            print(f"{count:>10} {formatName:>7} {len(body) / 1024:>10.1f} {seconds / count * 1e6:>10.2f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""Measure per-sample /stored-data latency as psyche_patientdata grows.
+
+    python benchmarks/ingest_scaling.py --db-url postgresql://localhost/psyche_bench --sizes 10000 100000 1000000
+
+Point --db-url at a scratch database: the script creates and fills the tables
+it needs. Without --db-url a temporary SQLite file is used.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--db-url', default=None)
+parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+parser.add_argument('--samples', type=int, default=500)
+parser.add_argument('--devices', type=int, default=20)
+args = parser.parse_args()
+
+os.environ['POSTGRES_URL'] = args.db_url or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'psyche_bench.db')
+os.environ.setdefault('SMTP_PORT', '25')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+import index
+from sqlalchemy import text
+
+def createTables(connection):
+    index.createSchema(connection)
+    for table in ('psyche_registereddevices', 'psyche_patientdata', 'psyche_sessionsummary'):
+        connection.execute(text(f'DELETE FROM {table}'))
+    deviceValues = [
+        {'devid': f"ST-{devID:02d}", 'ptid': f'B{devID:03d}', 'ptname': f'Bench Patient {devID}', 'lastassignment': datetime.utcnow()}
+        for devID in range(1, args.devices + 1)
+    ]
+    connection.execute(text('''
+        INSERT INTO psyche_registereddevices (devtype, devid, devassigned, lastassignment, devbattery, devassignedname)
+        VALUES ('Wearable', :devid, :ptid, :lastassignment, 100, :ptname)
+    '''), deviceValues)
+
+def growPatientData(connection, currentRows, targetRows, chunkSize=20000):
+    insertQuery = text('''
+        INSERT INTO psyche_patientdata
+        (ptid, ptname, timestamp, devid, accx, accy, accz, gyrox, gyroy, gyroz, hr, presence, battery)
+        VALUES (:ptid, :ptname, :timestamp, :devid, :accx, :accy, :accz, :gyrox, :gyroy, :gyroz, :hr, :presence, :battery)
+    ''')
+    start = datetime.utcnow() - timedelta(days=30)
+    while currentRows < targetRows:
+        count = min(chunkSize, targetRows - currentRows)
+        rows = []
+        for offset in range(currentRows, currentRows + count):
+            devID = offset % args.devices + 1
+            rows.append({
+                'ptid': f'B{devID:03d}', 'ptname': f'Bench Patient {devID}',
+                'timestamp': start + timedelta(milliseconds=offset * 50), 'devid': str(devID),
+                'accx': random.random(), 'accy': random.random(), 'accz': random.random(),
+                'gyrox': random.random(), 'gyroy': random.random(), 'gyroz': random.random(),
+                'hr': random.randint(55, 110), 'presence': 1, 'battery': 100 - offset % 100,
+            })
+        connection.execute(insertQuery, rows)
+        currentRows += count
+    return currentRows
+
+def timeIngest(client):
+    latencies = []
+    for sample in range(args.samples):
+        devID = sample % args.devices + 1
+        frame = ','.join([str(devID)] + [f'{random.random():.4f}' for _ in range(6)] + ['72', '1', str(90 - sample % 3)])
+        start = time.perf_counter()
+        response = client.post('/stored-data', data=frame)
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code == 200, response.data
+    return latencies
+
+def main():
+    engine = index.getEngine()
+    with engine.begin() as connection:
+        createTables(connection)
+
+    client = index.app.test_client()
+    currentRows = 0
+    print(f"{'rows':>12} {'mean ms':>10} {'p50 ms':>10} {'p95 ms':>10}")
+    for size in sorted(args.sizes):
+        with engine.begin() as connection:
+            currentRows = growPatientData(connection, currentRows, size)
+        latencies = timeIngest(client)
+        currentRows += args.samples
+        quantiles = statistics.quantiles(latencies, n=20)
+        print(f"{size:>12} {statistics.mean(latencies) * 1000:>10.3f} {quantiles[9] * 1000:>10.3f} {quantiles[18] * 1000:>10.3f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""Drive the Flask app with a mixed device and dashboard load and report per-endpoint latency.
+
+    python benchmarks/load_test.py --db-url postgresql://localhost/psyche_bench --sizes 10000 1000000 10000000
+    python benchmarks/load_test.py --sizes 10000 100000 --duration 20 --concurrency 16
+
+Point --db-url at a scratch database: the fixture generator creates the
+tables and fills them with synthetic patients and samples. Without --db-url a
+temporary SQLite file is used. For each table size the generator grows
+psyche_patientdata, then worker threads replay a weighted mix of /stored-data
+frames from ST-xx devices, /get-sessions, /get-devices and /export-sessions
+for --duration seconds. Exports delete the data they stream, so each one
+targets its own small fixture patient.
+"""
+import argparse
+import io
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--db-url', default=None)
+parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+parser.add_argument('--devices', type=int, default=40)
+parser.add_argument('--duration', type=float, default=10)
+parser.add_argument('--concurrency', type=int, default=8)
+parser.add_argument('--exports', type=int, default=20, help='Export fixture patients seeded per size.')
+parser.add_argument('--export-rows', type=int, default=20000)
+parser.add_argument('--mix', default='stored-data=80,get-sessions=8,get-devices=8,export-sessions=4')
+parser.add_argument('--seed-only', action='store_true', help='Seed fixtures for the largest size and exit.')
+args = parser.parse_args()
+
+os.environ['POSTGRES_URL'] = args.db_url or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'psyche_load.db')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+import index
+from sqlalchemy import text
+
+def seedDevices(connection):
+    index.createSchema(connection)
+    for table in ('psyche_registereddevices', 'psyche_patientdata', 'psyche_sessionsummary', 'psychepatientinfo'):
+        connection.execute(text(f'DELETE FROM {table}'))
+    connection.execute(text('''
+        INSERT INTO psyche_registereddevices (devtype, devid, devassigned, lastassignment, devbattery, devassignedname)
+        VALUES ('Wearable', :devid, :ptid, :lastassignment, 100, :ptname)
+    '''), [
+        {'devid': f'ST-{devID:02d}', 'ptid': f'L{devID:03d}', 'ptname': f'Load Patient {devID}', 'lastassignment': datetime.utcnow()}
+        for devID in range(1, args.devices + 1)
+    ])
+    connection.execute(text('''
+        INSERT INTO psychepatientinfo (ptid, ptname, ptsex, ptage, pttag)
+        VALUES (:ptid, :ptname, 'U', 40, 'Load')
+    '''), [{'ptid': f'L{devID:03d}', 'ptname': f'Load Patient {devID}'} for devID in range(1, args.devices + 1)])
+
+def fixtureRows(ptIDs, firstRow, rowCount, start):
+    for offset in range(firstRow, firstRow + rowCount):
+        ptID, ptName, devID = ptIDs[offset % len(ptIDs)]
+        yield (
+            ptID, ptName, start + timedelta(milliseconds=offset // len(ptIDs) * 50), devID,
+            round(random.gauss(0, 1), 4), round(random.gauss(0, 1), 4), round(random.gauss(9.8, 1), 4),
+            round(random.gauss(0, 0.5), 4), round(random.gauss(0, 0.5), 4), round(random.gauss(0, 0.5), 4),
+            random.randint(55, 110), 1, 100 - offset % 100
+        )
+
+def insertFixtureRows(connection, rows):
+    patientDataRows = [dict(zip(index.patientDataColumns, row)) for row in rows]
+    index.updateSessionSummaries(connection, patientDataRows)
+    if connection.dialect.name == 'postgresql':
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write('\t'.join(value.isoformat() if isinstance(value, datetime) else str(value) for value in row) + '\n')
+        buffer.seek(0)
+        with connection.connection.cursor() as cursor:
+            cursor.copy_expert(f"COPY psyche_patientdata ({', '.join(index.patientDataColumns)}) FROM STDIN", buffer)
+        return
+    connection.execute(text(f'''
+        INSERT INTO psyche_patientdata ({', '.join(index.patientDataColumns)})
+        VALUES ({', '.join(':' + column for column in index.patientDataColumns)})
+    '''), patientDataRows)
+
+def growPatientData(connection, currentRows, targetRows, chunkRows=50000):
+    ptIDs = [(f'L{devID:03d}', f'Load Patient {devID}', str(devID)) for devID in range(1, args.devices + 1)]
+    start = datetime.utcnow() - timedelta(milliseconds=targetRows // len(ptIDs) * 50) - timedelta(minutes=5)
+    if connection.dialect.name == 'postgresql' and index.isPartitioned(connection):
+        index.createPartitions(connection, start, datetime.utcnow())
+    while currentRows < targetRows:
+        count = min(chunkRows, targetRows - currentRows)
+        insertFixtureRows(connection, list(fixtureRows(ptIDs, currentRows, count, start)))
+        currentRows += count
+    return currentRows
+
+def seedExportPatients(connection, size):
+    exportIDs = [(f'E{size}N{number:03d}', f'Export Patient {number}', '0') for number in range(args.exports)]
+    for ptID in exportIDs:
+        insertFixtureRows(connection, list(fixtureRows([ptID], 0, args.export_rows, datetime.utcnow() - timedelta(hours=1))))
+    return [f'{ptName}-{ptID}_RTData' for ptID, ptName, _ in exportIDs]
+
+def storedDataRequest(client, exportNames):
+    devID = random.randint(1, args.devices)
+    frame = ','.join([str(devID)] + [f'{random.gauss(0, 1):.4f}' for _ in range(6)] + [str(random.randint(55, 110)), '1', str(random.randint(20, 100))])
+    return client.post('/stored-data', data=frame)
+
+def exportRequest(client, exportNames):
+    try:
+        fileName = exportNames.pop()
+    except IndexError:
+        return None
+    response = client.post('/export-sessions', json={'fileName': fileName})
+    response.get_data()
+    return response
+
+endpoints = {
+    'stored-data': storedDataRequest,
+    'get-sessions': lambda client, exportNames: client.get('/get-sessions'),
+    'get-devices': lambda client, exportNames: client.get('/get-devices'),
+    'export-sessions': exportRequest,
+}
+
+def parseMix(mix):
+    weights = {}
+    for item in mix.split(','):
+        name, weight = item.split('=')
+        if name not in endpoints:
+            raise SystemExit(f'Unknown endpoint in --mix: {name}')
+        weights[name] = float(weight)
+    return list(weights), list(weights.values())
+
+def runLoad(exportNames):
+    names, weights = parseMix(args.mix)
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+
+    def worker():
+        client = index.app.test_client()
+        while time.perf_counter() < deadline:
+            name = random.choices(names, weights)[0]
+            start = time.perf_counter()
+            response = endpoints[name](client, exportNames)
+            elapsed = time.perf_counter() - start
+            if response is None:
+                continue
+            with lock:
+                latencies[name].append(elapsed)
+                if response.status_code >= 400:
+                    errors[name] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        for future in [executor.submit(worker) for _ in range(args.concurrency)]:
+            future.result()
+    return latencies, errors, time.perf_counter() - started
+
+def percentile(values, fraction):
+    return sorted(values)[min(int(len(values) * fraction), len(values) - 1)]
+
+def main():
+    engine = index.getEngine()
+    with engine.begin() as connection:
+        seedDevices(connection)
+
+    currentRows = 0
+    print(f"{'rows':>10} {'endpoint':>16} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for size in sorted(args.sizes) if not args.seed_only else [max(args.sizes)]:
+        with engine.begin() as connection:
+            currentRows = growPatientData(connection, currentRows, size)
+            exportNames = seedExportPatients(connection, size)
+        if args.seed_only:
+            print(f'Seeded {currentRows} rows and {len(exportNames)} export patients.')
+            return
+
+        latencies, errors, elapsed = runLoad(exportNames)
+        for name, values in latencies.items():
+            if not values:
+                continue
+            print(f"{size:>10} {name:>16} {len(values):>9} {errors[name]:>7} {len(values) / elapsed:>9.1f} "
+                  f"{percentile(values, 0.5) * 1000:>9.2f} {percentile(values, 0.95) * 1000:>9.2f} {percentile(values, 0.99) * 1000:>9.2f}")
+        with engine.connect() as connection:
+            currentRows = connection.execute(text('SELECT COUNT(*) FROM psyche_patientdata')).scalar()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,11 @@
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:' + os.getenv('PORT', '8000'))
+workers = int(os.getenv('WEB_CONCURRENCY', 1))
+worker_class = 'gevent'
+worker_connections = int(os.getenv('WORKER_CONNECTIONS', 1000))
+timeout = int(os.getenv('WORKER_TIMEOUT', 60))
+
+def post_fork(server, worker):
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
@@ -0,0 +1,39 @@
+import os
+import sys
+import tempfile
+import time
+
+os.environ['POSTGRES_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'psyche_test.db')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'api'))
+
+import pytest
+from sqlalchemy import text
+
+import index
+
+@pytest.fixture
+def client():
+    with index.getEngine().begin() as connection:
+        index.createSchema(connection)
+        for table in ('psyche_registereddevices', 'psyche_patientdata', 'psyche_sessionsummary', 'psychepatientinfo'):
+            connection.execute(text(f'DELETE FROM {table}'))
+        connection.execute(text('''
+            INSERT INTO psyche_registereddevices (devtype, devid, devassigned, lastassignment, devbattery, devassignedname)
+            VALUES ('Wearable', 'ST-01', 'P1', NULL, 100, 'Pat One'), ('Wearable', 'ST-02', 'None', NULL, 100, 'None')
+        '''))
+        connection.execute(text('''
+            INSERT INTO psychepatientinfo (ptid, ptname, ptsex, ptage, pttag)
+            VALUES ('P1', 'Pat One', 'U', 40, 'Test')
+        '''))
+    index.deviceAssignments.invalidate(['ST-01', 'ST-02'])
+    return index.app.test_client()
+
+def patientDataCount():
+    with index.getEngine().connect() as connection:
+        return connection.execute(text('SELECT COUNT(*) FROM psyche_patientdata')).scalar()
+
+def waitFor(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
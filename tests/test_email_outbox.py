@@ -0,0 +1,123 @@
+import socketserver
+import threading
+import time
+
+import pytest
+from sqlalchemy import text
+
+import index
+from conftest import waitFor
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPSession)
+        self.messages = []
+        self.refusals = {}
+
+class SMTPSession(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 localhost')
+        recipients = []
+        while True:
+            line = self.rfile.readline().decode().rstrip('\r\n')
+            if not line:
+                return
+            verb = line.split(' ')[0].upper()
+            if verb == 'RCPT':
+                recipient = line.split(':', 1)[1].strip('<> ')
+                if self.server.refusals.get(recipient, 0) > 0:
+                    self.server.refusals[recipient] -= 1
+                    self.reply('451 Try again later')
+                    continue
+                recipients.append(recipient)
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                lines = []
+                while True:
+                    dataLine = self.rfile.readline().decode().rstrip('\r\n')
+                    if dataLine == '.':
+                        break
+                    lines.append(dataLine)
+                self.server.messages.append((recipients, '\n'.join(lines), time.monotonic()))
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('250 localhost')
+
+@pytest.fixture
+def smtpServer(monkeypatch):
+    server = SMTPStandIn()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv('SMTP_HOST', '127.0.0.1')
+    monkeypatch.setenv('SMTP_PORT', str(server.server_address[1]))
+    monkeypatch.setenv('SMTP_STARTTLS', '0')
+    monkeypatch.setenv('SMTP_FROM', 'psyche@example.com')
+    monkeypatch.delenv('SMTP_USER', raising=False)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def resetUser(client):
+    with index.getEngine().begin() as connection:
+        connection.execute(text('DELETE FROM psycheusers'))
+        connection.execute(text('''
+            INSERT INTO psycheusers (firstname, lastname, username, email, password, hashedpassword, salt, image)
+            VALUES ('Pat', 'User', 'patuser', 'pat@example.com', '', '', '', '')
+        '''))
+    return client
+
+def test_reset_password_delivers_code(resetUser, smtpServer, monkeypatch):
+    outbox = index.EmailOutbox(5, 30)
+    monkeypatch.setattr(index, 'emailOutbox', outbox)
+    try:
+        response = resetUser.post('/reset-password', json={'email': 'pat@example.com'})
+        assert response.status_code == 200
+        assert waitFor(lambda: smtpServer.messages)
+        recipients, message, _ = smtpServer.messages[0]
+        assert recipients == ['pat@example.com']
+        assert response.get_json()['resetCode'] in message
+    finally:
+        outbox.close()
+
+def test_failed_email_is_retried_without_blocking_others(smtpServer):
+    smtpServer.refusals['slow@example.com'] = 1
+    outbox = index.EmailOutbox(5, 30)
+    try:
+        started = time.monotonic()
+        outbox.send('slow@example.com', 'Subject: First\n\nfirst')
+        outbox.send('fast@example.com', 'Subject: Second\n\nsecond')
+
+        assert waitFor(lambda: len(smtpServer.messages) == 1)
+        assert smtpServer.messages[0][0] == ['fast@example.com']
+        assert smtpServer.messages[0][2] - started < 1
+        assert outbox.stats()['pending'] == 1
+
+        assert waitFor(lambda: len(smtpServer.messages) == 2, timeout=5)
+        assert smtpServer.messages[1][0] == ['slow@example.com']
+        assert outbox.stats() == {"pending": 0, "sent": 2, "retried": 1, "failed": 0}
+    finally:
+        outbox.close()
+
+def test_serverless_outbox_sends_inside_the_request(resetUser, smtpServer, monkeypatch):
+    monkeypatch.setattr(index, 'emailOutbox', index.EmailOutbox(5, 30, background=False))
+    response = resetUser.post('/reset-password', json={'email': 'pat@example.com'})
+    assert response.status_code == 200
+    assert len(smtpServer.messages) == 1
+    assert index.emailOutbox.thread is None
+
+    smtpServer.refusals['pat@example.com'] = 2
+    response = resetUser.post('/reset-password', json={'email': 'pat@example.com'})
+    assert response.status_code == 501
+    assert len(smtpServer.messages) == 1
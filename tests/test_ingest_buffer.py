@@ -0,0 +1,56 @@
+from datetime import datetime
+
+import index
+from conftest import patientDataCount, waitFor
+
+def sampleRow(second):
+    return index.patientDataRow('P1', 'Pat One', {
+        'timestamp': datetime(2024, 1, 1, 0, 0, second), 'devID': '1', 'accX': 0.0, 'accY': 0.0, 'accZ': 1.0,
+        'gyroX': 0.0, 'gyroY': 0.0, 'gyroZ': 0.0, 'hr': 70.0, 'presence': 1, 'battery': 90.0
+    })
+
+def test_age_flush_after_queue_drains(client):
+    ingestBuffer = index.IngestBuffer(100, 10, 0.2)
+    try:
+        assert ingestBuffer.put([sampleRow(0)])
+        assert waitFor(lambda: ingestBuffer.stats()['flushedRows'] == 1)
+
+        assert ingestBuffer.put([sampleRow(1)])
+        assert waitFor(lambda: ingestBuffer.stats()['flushedRows'] == 2, timeout=1)
+        assert ingestBuffer.stats()['pending'] == 0
+        assert patientDataCount() == 2
+    finally:
+        ingestBuffer.close()
+
+def test_non_numeric_sample_is_rejected_before_queuing(client, monkeypatch):
+    ingestBuffer = index.IngestBuffer(100, 10, 0.2)
+    monkeypatch.setattr(index, 'ingestBuffer', ingestBuffer)
+    try:
+        response = client.post('/stored-data', data='1,abc,0,9.8,0,0,0,70,1,90')
+        assert response.status_code == 400
+        assert ingestBuffer.stats()['pending'] == 0
+
+        response = client.post('/stored-data', data='1,0,0,9.8,0,0,0,70,1,90')
+        assert response.status_code == 200
+        assert waitFor(lambda: ingestBuffer.stats()['flushedRows'] == 1)
+        assert ingestBuffer.stats()['failedFlushes'] == 0
+        assert patientDataCount() == 1
+    finally:
+        ingestBuffer.close()
+
+def test_batch_rejects_non_numeric_lines(client, monkeypatch):
+    ingestBuffer = index.IngestBuffer(100, 10, 0.2)
+    monkeypatch.setattr(index, 'ingestBuffer', ingestBuffer)
+    try:
+        body = '\n'.join([
+            '2024-01-01T00:00:00,1,0,0,9.8,0,0,0,70,1,90',
+            '2024-01-01T00:00:01,1,0,0,9.8,0,0,0,seventy,1,90',
+            '2024-01-01T00:00:02,1,0,0,9.8,0,0,0,71,1,90'
+        ])
+        response = client.post('/stored-data-batch', data=body)
+        assert response.status_code == 200
+        assert response.get_json()['rejected'] == [1]
+        assert waitFor(lambda: ingestBuffer.stats()['flushedRows'] == 2)
+        assert ingestBuffer.stats()['failedFlushes'] == 0
+    finally:
+        ingestBuffer.close()
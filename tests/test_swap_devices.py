@@ -0,0 +1,52 @@
+from sqlalchemy import text
+
+import index
+
+def deviceOwners():
+    with index.getEngine().connect() as connection:
+        return dict(connection.execute(text('SELECT devid, devassigned FROM psyche_registereddevices')).fetchall())
+
+def addPatientWithDevice(ptID, devID):
+    with index.getEngine().begin() as connection:
+        connection.execute(text('''
+            INSERT INTO psychepatientinfo (ptid, ptname, ptsex, ptage, pttag)
+            VALUES (:ptid, :ptid, 'U', 40, 'Test')
+        '''), {'ptid': ptID})
+        connection.execute(text('''
+            INSERT INTO psyche_registereddevices (devtype, devid, devassigned, lastassignment, devbattery, devassignedname)
+            VALUES ('Wearable', :devid, :ptid, NULL, 100, :ptid)
+        '''), {'devid': devID, 'ptid': ptID})
+
+def swapResults(client, swaps):
+    response = client.post('/swap-devices', json={'swaps': swaps})
+    assert response.status_code == 200
+    return [(result['status'], result.get('message')) for result in response.get_json()['results']]
+
+def test_swap_cannot_release_another_patients_device(client):
+    addPatientWithDevice('P2', 'ST-05')
+
+    assert swapResults(client, [{'ptID': 'P1', 'ptName': 'Pat One', 'oldDevID': 'ST-05', 'newDevID': 'ST-05'}]) == [
+        ('rejected', 'Old device is not assigned to this patient')
+    ]
+    assert swapResults(client, [{'ptID': 'P1', 'ptName': 'Pat One', 'newDevID': 'ST-05'}]) == [
+        ('rejected', 'Device is assigned to another patient')
+    ]
+    assert deviceOwners()['ST-05'] == 'P2'
+
+def test_swap_rotates_devices_between_patients(client):
+    addPatientWithDevice('P2', 'ST-05')
+
+    assert swapResults(client, [
+        {'ptID': 'P1', 'ptName': 'Pat One', 'oldDevID': 'ST-01', 'newDevID': 'ST-05'},
+        {'ptID': 'P2', 'ptName': 'P2', 'oldDevID': 'ST-05', 'newDevID': 'ST-01'}
+    ]) == [('assigned', None), ('assigned', None)]
+    assert deviceOwners()['ST-01'] == 'P2'
+    assert deviceOwners()['ST-05'] == 'P1'
+
+def test_swap_rejects_unknown_patients_and_malformed_requests(client):
+    assert swapResults(client, [{'ptID': 'P9', 'ptName': 'Nobody', 'newDevID': 'ST-02'}]) == [('rejected', 'Patient is not enrolled')]
+    assert deviceOwners()['ST-02'] == 'None'
+
+    for path, field in (('/swap-devices', 'swaps'), ('/enroll-patients', 'patients'), ('/register-devices', 'devices')):
+        assert client.post(path, json={field: {'a': 1}}).status_code == 400
+        assert client.post(path, json={field: ['x']}).status_code == 400